@@ -1,27 +1,284 @@
+from datetime import date
+from math import ceil
+
 from django.contrib import admin
-from .models import Book, UserProfile, Borrowing, Review
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Q
+from django.utils.functional import cached_property
+from . import reviews
+from .circulation import add_copies, bulk_update_status, copies_from_counts, invalidate, sync_availability
+from .models import Book, Copy, UserProfile, Borrowing, ArchivedBorrowing, ReturnedBook, Review, FeePolicy, FeeLedgerEntry
+
+# The changelists below are built for tables with millions of rows: counts
+# are estimated or capped, foreign keys are joined in the list query and
+# edited by raw id, filters offer fixed choices instead of scanning the
+# table for distinct values, and searches are prefix or exact matches that
+# an index can answer.
+
+ESTIMATE_ABOVE = 10000  # Smaller tables are counted exactly
+COUNT_CAP = 10000  # Filtered changelists count at most this many rows
+
+def estimated_row_count(queryset):
+    """The database's own row estimate for the queryset's table, or None if it keeps none"""
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'mysql':
+                cursor.execute(
+                    'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+                    [table])
+            elif connection.vendor == 'sqlite':
+                # Statistics written by ANALYZE; the first number is the table's row count
+                cursor.execute("SELECT name FROM sqlite_master WHERE name = 'sqlite_stat1'")
+                if cursor.fetchone() is None:
+                    return None
+                cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+            else:
+                return None
+            row = cursor.fetchone()
+    except DatabaseError:
+        return None
+    if row is None or row[0] is None:
+        return None
+    return int(str(row[0]).split()[0])
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that never runs a COUNT over a whole large table.
+
+    An unfiltered changelist shows the database's estimate of the table size
+    once it is above ESTIMATE_ABOVE. A filtered one counts at most COUNT_CAP
+    rows. Neither limits how far one can page: each page fetches one row
+    more than it shows to tell whether there is a next one.
+    """
+
+    count_label = None  # How count is shown when it is not exact
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset)
+            if estimate is not None and estimate > ESTIMATE_ABOVE:
+                self.count_label = f"about {estimate:,}"
+                return estimate
+        count = queryset.order_by()[:COUNT_CAP + 1].count()
+        if count > COUNT_CAP:
+            self.count_label = f"{COUNT_CAP:,}+"
+            return COUNT_CAP
+        return count
+
+    @property
+    def display_count(self):
+        return self.count_label or self.count
+
+    @cached_property
+    def num_pages(self):
+        # Replaced by page() once a page has shown where the rows really end
+        return ceil(max(self.count, 1) / self.per_page)
+
+    def validate_number(self, number):
+        """Any page from 1 up is valid; page() finds out whether it has rows"""
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(self.error_messages['invalid_page'])
+        if number < 1:
+            raise EmptyPage(self.error_messages['min_page'])
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage(self.error_messages['no_results'])
+        if len(rows) > self.per_page:
+            self.num_pages = max(self.num_pages, number + 1)
+        else:
+            self.num_pages = number
+        return self._get_page(rows[:self.per_page], number, self)
+
+SEARCH_LOOKUPS = {'^': 'istartswith', '=': 'iexact', '@': 'search'}
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False  # Skips the second, unfiltered COUNT on filtered pages
+    list_per_page = 50
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Match the whole search term against each search field.
+
+        A field on a related model becomes "fk IN (matching related ids)", so
+        the related table's index finds the matches and the foreign key index
+        finds their rows, instead of joining every row to test the condition.
+        """
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        condition = Q()
+        for field in self.get_search_fields(request):
+            lookup = SEARCH_LOOKUPS.get(field[0], 'icontains')
+            name = field.lstrip('^=@')
+            if '__' in name:
+                fk, related_name = name.split('__', 1)
+                related = self.model._meta.get_field(fk).related_model
+                matches = related._default_manager.filter(**{f'{related_name}__{lookup}': term}).values('pk')
+                condition |= Q(**{f'{fk}__in': matches})
+            else:
+                condition |= Q(**{f'{name}__{lookup}': term})
+        return queryset.filter(condition), False
+
+class PublishedDecadeFilter(admin.SimpleListFilter):
+    """Decades as fixed choices, instead of one choice per distinct published date"""
+    title = 'published'
+    parameter_name = 'decade'
+
+    def lookups(self, request, model_admin):
+        this_decade = date.today().year // 10 * 10
+        return [(str(decade), f"{decade}s") for decade in range(this_decade, 1890, -10)] + [('older', "Before 1900")]
 
-# Register your models here.
+    def queryset(self, request, queryset):
+        if self.value() == 'older':
+            return queryset.filter(published_date__lt=date(1900, 1, 1))
+        if self.value() and self.value().isdigit():
+            decade = int(self.value())
+            return queryset.filter(published_date__gte=date(decade, 1, 1), published_date__lt=date(decade + 10, 1, 1))
+        return queryset
+
+class AvailabilityFilter(admin.SimpleListFilter):
+    title = 'availability'
+    parameter_name = 'available'
+
+    def lookups(self, request, model_admin):
+        return [('yes', "On the shelf"), ('no', "None available")]
+
+    def queryset(self, request, queryset):
+        if self.value() == 'yes':
+            return queryset.filter(available_copies__gt=0)
+        if self.value() == 'no':
+            return queryset.filter(available_copies=0)
+        return queryset
 
 @admin.register(Book)
-class BookAdmin(admin.ModelAdmin):
+class BookAdmin(LargeTableAdmin):
     list_display = ('title', 'author', 'published_date', 'available_copies', 'cover_pic')
-    search_fields = ('title', 'author', 'category')
-    list_filter = ('title', 'author', 'published_date')
+    search_fields = ('^title', '^author', '=isbn')
+    list_filter = ('genre', AvailabilityFilter, PublishedDecadeFilter)
+    actions = ['add_copy']
+
+    def get_readonly_fields(self, request, obj=None):
+        # Books circulated by copy have their availability recounted from the copies
+        if obj is not None and obj.copies.exists():
+            return ('available_copies',)
+        return ()
+
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            super().save_model(request, obj, form, change)
+            if change and obj.copies.exists():
+                # The saved row holds the count from when the form was loaded
+                sync_availability([obj.id])
+                transaction.on_commit(lambda: invalidate(book_id=obj.id))
+
+    @admin.action(description="Add a copy to selected books")
+    def add_copy(self, request, queryset):
+        books = list(queryset)
+        with transaction.atomic():
+            copies_from_counts(book for book in books if not book.copies.exists())
+            for book in books:
+                add_copies(book, 1)
+            sync_availability([book.id for book in books])
+            for book in books:
+                transaction.on_commit(lambda book_id=book.id: invalidate(book_id=book_id))
+        self.message_user(request, f"Added a copy to {len(books)} book(s).")
+
+@admin.register(Copy)
+class CopyAdmin(LargeTableAdmin):
+    list_display = ('barcode', 'book', 'status', 'added_at')
+    list_filter = ('status',)
+    list_select_related = ('book',)
+    search_fields = ('=barcode', '=book__isbn')
+    raw_id_fields = ('book',)
 
 @admin.register(UserProfile)
-class UserProfileAdmin(admin.ModelAdmin):
+class UserProfileAdmin(LargeTableAdmin):
     list_display = ('user', 'bio')
-    search_fields = ('user__username', 'user__email', 'bio')
+    list_select_related = ('user',)
+    search_fields = ('^user__username', '=user__email')
+    raw_id_fields = ('user',)
 
 @admin.register(Borrowing)
-class BorrowingAdmin(admin.ModelAdmin):
+class BorrowingAdmin(LargeTableAdmin):
     list_display = ('book', 'user', 'borrowed_date', 'due_date', 'status', 'late_fee')
     list_filter = ('status', 'borrowed_date', 'due_date')
-    search_fields = ('book__title', 'user__username')
+    list_select_related = ('book', 'user')
+    search_fields = ('^book__title', '=book__isbn', '^user__username', '=copy__barcode')
+    raw_id_fields = ('book', 'user', 'copy')
+    actions = ['mark_returned', 'mark_overdue']
+
+    def _bulk_status(self, request, queryset, status):
+        report = bulk_update_status(status, borrowing_ids=list(queryset.values_list('id', flat=True)))
+        updated = sum(1 for entry in report if entry['updated'])
+        skipped = len(report) - updated
+        self.message_user(request, f"{updated} borrowing(s) marked {status.lower()}; {skipped} skipped.")
+
+    @admin.action(description="Mark selected borrowings as returned")
+    def mark_returned(self, request, queryset):
+        self._bulk_status(request, queryset, 'RETURNED')
+
+    @admin.action(description="Mark selected borrowings as overdue")
+    def mark_overdue(self, request, queryset):
+        self._bulk_status(request, queryset, 'OVERDUE')
+
+@admin.register(ArchivedBorrowing)
+class ArchivedBorrowingAdmin(LargeTableAdmin):
+    list_display = ('book', 'user', 'borrowed_date', 'returned_date', 'late_fee', 'archived_at')
+    list_filter = ('returned_date',)
+    list_select_related = ('book', 'user')
+    search_fields = ('^book__title', '=book__isbn', '^user__username')
+    raw_id_fields = ('book', 'user', 'copy')
+
+@admin.register(ReturnedBook)
+class ReturnedBookAdmin(LargeTableAdmin):
+    list_display = ('user', 'book', 'loans', 'late_fees', 'last_returned')
+    list_select_related = ('book', 'user')
+    search_fields = ('^book__title', '=book__isbn', '^user__username')
+    raw_id_fields = ('book', 'user')
 
 @admin.register(Review)
-class ReviewAdmin(admin.ModelAdmin):
-    list_display = ('book', 'user', 'rating', 'created_at')
-    list_filter = ('rating', 'created_at')
-    search_fields = ('book__title', 'user__username', 'comment')
\ No newline at end of file
+class ReviewAdmin(LargeTableAdmin):
+    list_display = ('book', 'user', 'rating', 'status', 'flags', 'created_at')
+    list_filter = ('status', 'rating', 'created_at')
+    list_select_related = ('book', 'user')
+    search_fields = ('^book__title', '=book__isbn', '^user__username')
+    raw_id_fields = ('book', 'user')
+    actions = ['approve', 'reject']
+
+    def _moderate(self, request, queryset, status):
+        selected = list(queryset.exclude(status=status))
+        reviews.moderate(selected, status)
+        self.message_user(request, f"{len(selected)} review(s) {status.lower()}.")
+
+    @admin.action(description="Approve selected reviews")
+    def approve(self, request, queryset):
+        self._moderate(request, queryset, 'APPROVED')
+
+    @admin.action(description="Reject selected reviews")
+    def reject(self, request, queryset):
+        self._moderate(request, queryset, 'REJECTED')
+
+@admin.register(FeePolicy)
+class FeePolicyAdmin(admin.ModelAdmin):
+    list_display = ('genre', 'daily_rate', 'grace_days', 'max_fee')
+
+@admin.register(FeeLedgerEntry)
+class FeeLedgerEntryAdmin(LargeTableAdmin):
+    list_display = ('user', 'entry_type', 'amount', 'borrowing', 'created_at')
+    list_filter = ('entry_type', 'created_at')
+    list_select_related = ('user', 'borrowing__book', 'borrowing__user')
+    search_fields = ('^user__username',)
+    raw_id_fields = ('user', 'borrowing', 'archived_borrowing')
\ No newline at end of file
@@ -0,0 +1,159 @@
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import Borrowing, DailyRollup, Review, RollupWatermark
+
+WATERMARK_NAME = 'daily_rollup'
+
+# Rows committed slightly after their timestamp (long transactions) would be
+# missed if we processed right up to "now", so stay this far behind.
+SETTLE_DELAY = timedelta(minutes=1)
+
+
+def _window(field, since, until):
+    """Q for field values in the half-open window (since, until]"""
+    q = Q(**{f'{field}__lte': until})
+    if since is not None:
+        q &= Q(**{f'{field}__gt': since})
+    return q
+
+
+def _grouped(queryset, date_field, **aggregates):
+    """Group rows by day and their book's genre and category in a single query"""
+    return (
+        queryset.order_by()
+        .annotate(day=TruncDate(date_field))
+        .values('day', 'book__genre', 'book__category')
+        .annotate(**aggregates)
+    )
+
+
+def collect_deltas(since, until):
+    """
+    Aggregate activity in (since, until] into per-(day, genre, category) deltas.
+
+    Every event is attributed to the moment it happened, so each one falls in
+    exactly one window:
+    - borrows on borrowed_date
+    - returns and the late fees charged for them on returned_date
+    - overdues on due_date, for loans not returned by then
+    - ratings as review status changes: see _rating_changes
+    """
+    deltas = defaultdict(lambda: defaultdict(int))
+
+    def add(rows, **fields):
+        for row in rows:
+            key = (row['day'], row['book__genre'], row['book__category'])
+            for field, source in fields.items():
+                deltas[key][field] += row[source] or 0
+
+    add(_grouped(Borrowing.objects.filter(_window('borrowed_date', since, until)),
+                 'borrowed_date', n=Count('id')),
+        borrows='n')
+    add(_grouped(Borrowing.objects.filter(_window('returned_date', since, until)),
+                 'returned_date', n=Count('id'), fees=Sum('late_fee')),
+        returns='n', late_fees_charged='fees')
+    add(_grouped(Borrowing.objects.filter(_window('due_date', since, until))
+                 .filter(Q(returned_date__isnull=True) | Q(returned_date__gt=F('due_date'))),
+                 'due_date', n=Count('id')),
+        overdues='n')
+    add(_rating_changes(since, until), rating_count='n', rating_sum='total')
+    return deltas
+
+
+def _rating_changes(since, until):
+    """
+    Rating changes of the reviews saved or moderated in (since, until].
+
+    Each review records the rating the rollups currently include
+    (rolled_up_rating; only approved reviews count), so an approval adds it,
+    an edit that sends it back to moderation or a rejection takes it out,
+    and a review approved again after an edit is not counted twice. Changes
+    are dated by the review's latest save or moderation. Marks the reviews
+    as rolled up; call inside the refresh transaction.
+    """
+    reviews = list(
+        Review.objects.filter(_window('updated_at', since, until) | _window('moderated_at', since, until))
+        .select_related('book').only('rating', 'status', 'rolled_up_rating', 'updated_at', 'moderated_at',
+                                     'book__genre', 'book__category')
+    )
+    rows = defaultdict(lambda: {'n': 0, 'total': 0})
+    changed = []
+    for review in reviews:
+        target = review.rating if review.status == 'APPROVED' else None
+        if target == review.rolled_up_rating:
+            continue
+        changed_at = max(filter(None, [review.updated_at, review.moderated_at]))
+        row = rows[(timezone.localdate(changed_at), review.book.genre, review.book.category)]
+        row['n'] += (target is not None) - (review.rolled_up_rating is not None)
+        row['total'] += (target or 0) - (review.rolled_up_rating or 0)
+        review.rolled_up_rating = target
+        changed.append(review)
+    Review.objects.bulk_update(changed, ['rolled_up_rating'], batch_size=1000)
+    return [
+        {'day': day, 'book__genre': genre, 'book__category': category, **row}
+        for (day, genre, category), row in rows.items()
+    ]
+
+
+def apply_deltas(deltas):
+    """Add deltas onto the stored rollup rows, creating missing rows"""
+    if not deltas:
+        return 0
+    dates = {key[0] for key in deltas}
+    existing = {
+        (row.date, row.genre, row.category): row
+        for row in DailyRollup.objects.filter(date__in=dates)
+    }
+    to_create, to_update = [], []
+    for key, values in deltas.items():
+        row = existing.get(key)
+        if row is None:
+            row = DailyRollup(date=key[0], genre=key[1], category=key[2], late_fees_charged=Decimal(0))
+            to_create.append(row)
+        else:
+            to_update.append(row)
+        for field, value in values.items():
+            if field == 'late_fees_charged':
+                value = Decimal(value)
+            setattr(row, field, getattr(row, field) + value)
+
+    DailyRollup.objects.bulk_create(to_create)
+    DailyRollup.objects.bulk_update(to_update, [
+        'borrows', 'returns', 'overdues', 'late_fees_charged', 'rating_sum', 'rating_count',
+    ])
+    return len(to_create) + len(to_update)
+
+
+def refresh_rollups(until=None):
+    """
+    Fold everything that happened since the last run into the rollups.
+
+    Only rows in the window after the stored watermark are read, so the cost
+    is proportional to new activity rather than to the size of the history.
+    Returns the number of rollup rows touched.
+    """
+    until = until or timezone.now() - SETTLE_DELAY
+    with transaction.atomic():
+        watermark = (
+            RollupWatermark.objects.select_for_update()
+            .filter(name=WATERMARK_NAME).first()
+        )
+        since = watermark.processed_until if watermark else None
+        if since is not None and since >= until:
+            return 0
+
+        touched = apply_deltas(collect_deltas(since, until))
+
+        if watermark is None:
+            RollupWatermark.objects.create(name=WATERMARK_NAME, processed_until=until)
+        else:
+            watermark.processed_until = until
+            watermark.save(update_fields=['processed_until'])
+    return touched
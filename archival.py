@@ -0,0 +1,110 @@
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .analytics import WATERMARK_NAME
+from .models import ArchivedBorrowing, Borrowing, FeeLedgerEntry, ReturnedBook, RollupWatermark
+
+# Hot/cold split of the loan history: Borrowing keeps open and recently
+# returned loans, older returns live in ArchivedBorrowing, and ReturnedBook
+# keeps one summary row per reader and book for the checks and counts that
+# must still see the whole history.
+ARCHIVE_AFTER = timedelta(days=getattr(settings, 'BORROWING_ARCHIVE_AFTER_DAYS', 180))
+
+
+def archive_cutoff(now=None, after=None):
+    """
+    Loans returned before this moment may be archived: after (default
+    ARCHIVE_AFTER) before now.
+
+    Never later than the analytics watermark: the rollups read Borrowing, so
+    a loan is only moved once every event of it has been rolled up. None
+    while the rollups have never run, when nothing may be archived yet.
+    """
+    cutoff = (now or timezone.now()) - (after or ARCHIVE_AFTER)
+    watermark = RollupWatermark.objects.filter(name=WATERMARK_NAME).values_list('processed_until', flat=True).first()
+    return min(cutoff, watermark) if watermark else None
+
+
+def archive_returned(cutoff=None, batch_size=1000):
+    """
+    Move returned loans older than the cutoff into the archive, in batches.
+
+    Each batch is one transaction: copy the loans, add them to their
+    readers' ReturnedBook summaries, repoint their fee ledger entries and
+    delete them from Borrowing. Run one archiver at a time. Returns the
+    number of loans archived (none before the first rollup run).
+    """
+    cutoff = cutoff or archive_cutoff()
+    if cutoff is None:
+        return 0
+    archived = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            loans = list(
+                Borrowing.objects.select_for_update()
+                .filter(status='RETURNED', returned_date__lt=cutoff, id__gt=last_id)
+                .order_by('id')[:batch_size]
+            )
+            if not loans:
+                break
+            _archive_batch(loans)
+        archived += len(loans)
+        last_id = loans[-1].id
+    return archived
+
+
+def _archive_batch(loans):
+    ids = [loan.id for loan in loans]
+    ArchivedBorrowing.objects.bulk_create([
+        ArchivedBorrowing(
+            id=loan.id, book_id=loan.book_id, copy_id=loan.copy_id, user_id=loan.user_id,
+            borrowed_date=loan.borrowed_date, due_date=loan.due_date, returned_date=loan.returned_date,
+            late_fee=loan.late_fee,
+        )
+        for loan in loans
+    ])
+
+    totals = defaultdict(lambda: {'loans': 0, 'late_fees': Decimal('0.00'), 'last_returned': None})
+    for loan in loans:
+        row = totals[(loan.user_id, loan.book_id)]
+        row['loans'] += 1
+        row['late_fees'] += loan.late_fee
+        row['last_returned'] = max(filter(None, [row['last_returned'], loan.returned_date]))
+    existing = ReturnedBook.objects.filter(
+        user_id__in={user_id for user_id, _ in totals}, book_id__in={book_id for _, book_id in totals})
+    changed = []
+    for summary in existing:
+        row = totals.pop((summary.user_id, summary.book_id), None)
+        if row:
+            summary.loans += row['loans']
+            summary.late_fees += row['late_fees']
+            summary.last_returned = max(filter(None, [summary.last_returned, row['last_returned']]))
+            changed.append(summary)
+    ReturnedBook.objects.bulk_update(changed, ['loans', 'late_fees', 'last_returned'])
+    ReturnedBook.objects.bulk_create([
+        ReturnedBook(user_id=user_id, book_id=book_id, **row) for (user_id, book_id), row in totals.items()
+    ])
+
+    FeeLedgerEntry.objects.filter(borrowing_id__in=ids).update(archived_borrowing_id=F('borrowing_id'), borrowing=None)
+    Borrowing.objects.filter(id__in=ids).delete()
+
+
+def has_returned(user_id, book_id):
+    """Whether the reader has ever returned the book, archived loans included"""
+    return (
+        Borrowing.objects.filter(user_id=user_id, book_id=book_id, status='RETURNED').exists()
+        or ReturnedBook.objects.filter(user_id=user_id, book_id=book_id).exists()
+    )
+
+
+def archived_totals(user_id):
+    """Number of archived loans and their late fees for one reader"""
+    totals = ReturnedBook.objects.filter(user_id=user_id).aggregate(loans=Sum('loans'), late_fees=Sum('late_fees'))
+    return totals['loans'] or 0, totals['late_fees'] or Decimal('0.00')
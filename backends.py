@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+
+# How long a logged-in user (and their profile) stays cached between saves
+USER_CACHE_TIMEOUT = getattr(settings, 'USER_CACHE_TIMEOUT', 60 * 15)
+# Must be shared by all workers, or a saved user stays cached in the others
+USER_CACHE_ALIAS = getattr(settings, 'USER_CACHE_ALIAS', 'default')
+
+
+def user_cache_key(user_id):
+    return f'library:user:{user_id}'
+
+
+def invalidate_user(user_id):
+    caches[USER_CACHE_ALIAS].delete(user_cache_key(user_id))
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend that serves request.user from the cache.
+
+    The user is loaded together with its UserProfile, so views can read
+    request.user.profile without another query. Entries are dropped by the
+    signal handlers in signals.py whenever a User or UserProfile is saved.
+    """
+
+    def _load_user(self, user_id):
+        UserModel = get_user_model()
+        try:
+            return UserModel._default_manager.select_related('profile').get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+
+    def get_user(self, user_id):
+        key = user_cache_key(user_id)
+        cache = caches[USER_CACHE_ALIAS]
+        user = cache.get(key)
+        if user is None:
+            user = self._load_user(user_id)
+            if user is None:
+                return None
+            cache.set(key, user, USER_CACHE_TIMEOUT)
+        return user if self.user_can_authenticate(user) else None
+
+    async def aget_user(self, user_id):
+        key = user_cache_key(user_id)
+        cache = caches[USER_CACHE_ALIAS]
+        user = await cache.aget(key)
+        if user is None:
+            UserModel = get_user_model()
+            try:
+                user = await UserModel._default_manager.select_related('profile').aget(pk=user_id)
+            except UserModel.DoesNotExist:
+                return None
+            await cache.aset(key, user, USER_CACHE_TIMEOUT)
+        return user if self.user_can_authenticate(user) else None
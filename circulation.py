@@ -0,0 +1,406 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, Count, Exists, F, OuterRef, PositiveIntegerField, Subquery, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .fees import compute_fee, load_policies, open_loans, policy_for, settle_return
+from .models import Book, Borrowing, Copy, FeeLedgerEntry
+
+# Write-through caches for the borrow flow. Entries are updated when a loan is
+# created or returned (after the transaction commits), and rebuilt from the
+# database on a miss; check_circulation_cache reports any drift. The cache is
+# only a pre-check: checkout() and checkout_copy() enforce the loan rules
+# again against the database before lending.
+#
+# Books with Copy rows are circulated by copy: each loan holds one copy and
+# available_copies is recounted from the copies' state whenever one changes.
+# Books that predate copy tracking (until create_copies runs) keep using the
+# plain counter.
+CIRCULATION_CACHE_TIMEOUT = getattr(settings, 'CIRCULATION_CACHE_TIMEOUT', 60 * 60 * 24)
+MAX_ACTIVE_LOANS = 5
+
+
+def loan_state_key(user_id):
+    return f'library:loans:{user_id}'
+
+
+def availability_key(book_id):
+    return f'library:availability:{book_id}'
+
+
+def _load_loan_state(user_id):
+    return sorted(open_loans().filter(user_id=user_id).values_list('book_id', flat=True))
+
+
+def get_loan_state(user_id):
+    """Ids of the books the user currently has out (one entry per open loan)"""
+    book_ids = cache.get(loan_state_key(user_id))
+    if book_ids is None:
+        book_ids = _load_loan_state(user_id)
+        cache.set(loan_state_key(user_id), book_ids, CIRCULATION_CACHE_TIMEOUT)
+    return book_ids
+
+
+async def aget_loan_state(user_id):
+    book_ids = await cache.aget(loan_state_key(user_id))
+    if book_ids is None:
+        book_ids = sorted([
+            book_id async for book_id in
+            open_loans().filter(user_id=user_id).values_list('book_id', flat=True)
+        ])
+        await cache.aset(loan_state_key(user_id), book_ids, CIRCULATION_CACHE_TIMEOUT)
+    return book_ids
+
+
+def get_availability(book_id):
+    copies = cache.get(availability_key(book_id))
+    if copies is None:
+        copies = Book.objects.filter(id=book_id).values_list('available_copies', flat=True).first() or 0
+        cache.set(availability_key(book_id), copies, CIRCULATION_CACHE_TIMEOUT)
+    return copies
+
+
+async def aget_availability(book_id):
+    copies = await cache.aget(availability_key(book_id))
+    if copies is None:
+        copies = await Book.objects.filter(id=book_id).values_list('available_copies', flat=True).afirst() or 0
+        await cache.aset(availability_key(book_id), copies, CIRCULATION_CACHE_TIMEOUT)
+    return copies
+
+
+def _adjust_cache(user_id, book_id, delta, recounted=False):
+    """
+    Apply a borrow (delta=-1) or return (delta=+1) to the cached entries that exist.
+
+    Pass recounted=True when available_copies was recounted from the copies
+    rather than moved by delta; the cached availability is then dropped.
+    """
+    key = loan_state_key(user_id)
+    book_ids = cache.get(key)
+    if book_ids is not None:
+        if delta < 0:
+            book_ids = sorted(book_ids + [book_id])
+        elif book_id in book_ids:
+            book_ids.remove(book_id)
+        cache.set(key, book_ids, CIRCULATION_CACHE_TIMEOUT)
+    if recounted:
+        invalidate(book_id=book_id)
+        return
+    try:
+        cache.incr(availability_key(book_id), delta)
+    except ValueError:
+        pass  # Not cached; the next read loads it from the database
+
+
+def invalidate(user_id=None, book_id=None):
+    if user_id is not None:
+        cache.delete(loan_state_key(user_id))
+    if book_id is not None:
+        cache.delete(availability_key(book_id))
+
+
+async def ainvalidate(user_id=None, book_id=None):
+    if user_id is not None:
+        await cache.adelete(loan_state_key(user_id))
+    if book_id is not None:
+        await cache.adelete(availability_key(book_id))
+
+
+def barcode_for(book, number):
+    """Barcode printed on the label of a book's number-th copy"""
+    return f'{book.isbn}-{number:03d}'
+
+
+def add_copies(book, count):
+    """Register count new AVAILABLE copies of book, numbered after its highest barcode"""
+    prefix = f'{book.isbn}-'
+    numbers = [
+        int(barcode[len(prefix):])
+        for barcode in book.copies.filter(barcode__startswith=prefix).values_list('barcode', flat=True)
+        if barcode[len(prefix):].isdigit()
+    ]
+    start = max(numbers, default=0) + 1
+    return Copy.objects.bulk_create([
+        Copy(book=book, barcode=barcode_for(book, number)) for number in range(start, start + count)
+    ])
+
+
+def sync_availability(book_ids=None):
+    """
+    Recount available_copies from copy state with one UPDATE.
+
+    Only books that have copies are touched; returns the number of books
+    recounted. Without book_ids every copy-tracked book is recounted, which
+    repairs any drift in the stored counts.
+    """
+    books = Book.objects.filter(Exists(Copy.objects.filter(book=OuterRef('pk'))))
+    if book_ids is not None:
+        books = books.filter(id__in=book_ids)
+    available = (
+        Copy.objects.filter(book=OuterRef('pk'), status='AVAILABLE')
+        .order_by().values('book').annotate(n=Count('id')).values('n')
+    )
+    return books.update(available_copies=Coalesce(Subquery(available), 0))
+
+
+def copies_from_counts(books):
+    """
+    Create the copies of books that predate copy tracking, in bulk.
+
+    Each book gets one ON_LOAN copy per open loan (linked to that loan) and
+    one AVAILABLE copy per available_copies, so the counts are unchanged.
+    Returns the number of copies created.
+    """
+    books = list(books)
+    loans = {}
+    for loan in open_loans().filter(book__in=books).only('id', 'book_id').order_by('id'):
+        loans.setdefault(loan.book_id, []).append(loan)
+
+    copies = []
+    loan_barcodes = {}
+    for book in books:
+        book_loans = loans.get(book.id, [])
+        for number, loan in enumerate(book_loans, 1):
+            loan_barcodes[barcode_for(book, number)] = loan
+            copies.append(Copy(book=book, barcode=barcode_for(book, number), status='ON_LOAN'))
+        first_free = len(book_loans) + 1
+        copies.extend(
+            Copy(book=book, barcode=barcode_for(book, number))
+            for number in range(first_free, first_free + book.available_copies)
+        )
+
+    with transaction.atomic():
+        Copy.objects.bulk_create(copies, batch_size=1000)
+        # Not every backend returns primary keys from bulk_create, so look them up
+        for barcode, copy_id in Copy.objects.filter(barcode__in=loan_barcodes).values_list('barcode', 'id'):
+            loan_barcodes[barcode].copy_id = copy_id
+        Borrowing.objects.bulk_update(loan_barcodes.values(), ['copy'], batch_size=1000)
+    return len(copies)
+
+
+def loan_refusal(user, book_id):
+    """
+    Why the user may not borrow book_id right now, or None.
+
+    Call inside the lending transaction: locks the user row, so concurrent
+    checkouts for one reader queue up, and reads their open loans with one
+    indexed query. Returns 'already borrowed' or 'limit'.
+    """
+    User.objects.select_for_update().filter(id=user.id).values_list('id', flat=True).first()
+    book_ids = list(open_loans().filter(user=user).values_list('book_id', flat=True))
+    if book_id in book_ids:
+        return 'already borrowed'
+    if len(book_ids) >= MAX_ACTIVE_LOANS:
+        return 'limit'
+    return None
+
+
+def checkout(book, user, due_date):
+    """
+    Create a loan and take a copy off the shelf in one transaction.
+
+    Returns (borrowing, refusal): borrowing is None when refusal says why,
+    'already borrowed', 'limit' (see loan_refusal) or 'unavailable' if the
+    last copy went out first.
+    """
+    with transaction.atomic():
+        refusal = loan_refusal(user, book.id)
+        if refusal:
+            # The cached loan state let this through, so it is stale
+            transaction.on_commit(lambda: invalidate(user_id=user.id))
+            return None, refusal
+        copy = (
+            Copy.objects.select_for_update(skip_locked=True)
+            .filter(book=book, status='AVAILABLE').order_by('id').first()
+        )
+        if copy is not None:
+            # Guarded flip, for backends without row locks
+            taken = Copy.objects.filter(id=copy.id, status='AVAILABLE').update(status='ON_LOAN')
+            if taken:
+                copy.status = 'ON_LOAN'
+                sync_availability([book.id])
+        elif Copy.objects.filter(book=book).exists():
+            taken = False
+        else:
+            taken = Book.objects.filter(id=book.id, available_copies__gt=0).update(
+                available_copies=F('available_copies') - 1)
+        if not taken:
+            transaction.on_commit(lambda: invalidate(book_id=book.id))
+            return None, 'unavailable'
+        borrowing = Borrowing.objects.create(book=book, copy=copy, user=user, due_date=due_date, status='BORROWED')
+        transaction.on_commit(lambda: _adjust_cache(user.id, book.id, -1, recounted=copy is not None))
+    return borrowing, None
+
+
+def checkin(borrowing):
+    """
+    Put a returned loan's copy back on the shelf.
+
+    Call inside the transaction that saves the returned borrowing.
+    """
+    if borrowing.copy_id:
+        Copy.objects.filter(id=borrowing.copy_id).update(status='AVAILABLE')
+        sync_availability([borrowing.book_id])
+    else:
+        Book.objects.filter(id=borrowing.book_id).update(available_copies=F('available_copies') + 1)
+    transaction.on_commit(lambda: _adjust_cache(
+        borrowing.user_id, borrowing.book_id, +1, recounted=bool(borrowing.copy_id)))
+
+
+def checkout_copy(barcode, user, due_date):
+    """
+    Lend the scanned copy to user at the circulation desk.
+
+    Returns (borrowing, result); borrowing is None when the scan is refused.
+    """
+    copy = Copy.objects.select_related('book').filter(barcode=barcode).first()
+    if copy is None:
+        return None, "Unknown barcode"
+    if copy.status != 'AVAILABLE':
+        return None, f"Copy is {copy.get_status_display().lower()}"
+    if len(get_loan_state(user.id)) >= MAX_ACTIVE_LOANS:
+        return None, f"{user.username} has reached the borrowing limit ({MAX_ACTIVE_LOANS} books)"
+
+    with transaction.atomic():
+        refusal = loan_refusal(user, copy.book_id)
+        if refusal:
+            transaction.on_commit(lambda: invalidate(user_id=user.id))
+            if refusal == 'limit':
+                return None, f"{user.username} has reached the borrowing limit ({MAX_ACTIVE_LOANS} books)"
+            return None, f"{user.username} already has a copy of this book"
+        if not Copy.objects.filter(id=copy.id, status='AVAILABLE').update(status='ON_LOAN'):
+            return None, "Copy was checked out by another desk"
+        copy.status = 'ON_LOAN'
+        sync_availability([copy.book_id])
+        borrowing = Borrowing.objects.create(
+            book=copy.book, copy=copy, user=user, due_date=due_date, status='BORROWED')
+        transaction.on_commit(lambda: _adjust_cache(user.id, copy.book_id, -1, recounted=True))
+    return borrowing, f"Checked out to {user.username}"
+
+
+def checkin_copy(barcode, returned_at=None):
+    """
+    Return the scanned copy, settling any late fee.
+
+    Returns (borrowing, result); borrowing is None when the copy is not out.
+    """
+    with transaction.atomic():
+        borrowing = (
+            open_loans().select_for_update().select_related('book', 'user')
+            .filter(copy__barcode=barcode).first()
+        )
+        if borrowing is None:
+            if Copy.objects.filter(barcode=barcode).exists():
+                return None, "Copy is not on loan"
+            return None, "Unknown barcode"
+        borrowing.status = 'RETURNED'
+        fee = settle_return(borrowing, returned_at or timezone.now())
+        borrowing.save()
+        checkin(borrowing)
+    if fee > 0:
+        return borrowing, f"Returned late by {borrowing.user.username}; late fee ${fee}"
+    return borrowing, f"Returned by {borrowing.user.username}"
+
+
+def bulk_update_status(new_status, borrowing_ids=(), isbns=(), now=None):
+    """
+    Apply one status change to many loans in a single transaction.
+
+    Loans are given by id, or by scanned ISBN (each scan selects the oldest
+    still-open loan of that book not already picked by id or an earlier scan).
+    Returns a per-item report: a list of dicts with item, borrowing and result.
+    Only open loans can change status; returns settle late fees, post ledger
+    charges and put copies back on the shelf with one grouped UPDATE.
+    """
+    now = now or timezone.now()
+    report = []
+    with transaction.atomic():
+        by_id = Borrowing.objects.select_for_update().select_related('book').in_bulk(
+            borrowing_ids)
+        targets = []
+        for item in borrowing_ids:
+            borrowing = by_id.get(item)
+            report.append({'item': item, 'kind': 'id', 'borrowing': borrowing, 'updated': False})
+            targets.append(borrowing)
+
+        if isbns:
+            candidates = {}
+            for borrowing in (open_loans().select_for_update().select_related('book')
+                              .filter(book__isbn__in=set(isbns)).exclude(id__in=list(by_id))
+                              .order_by('borrowed_date', 'id')):
+                candidates.setdefault(borrowing.book.isbn, []).append(borrowing)
+            for isbn in isbns:
+                queue = candidates.get(isbn)
+                borrowing = queue.pop(0) if queue else None
+                report.append({'item': isbn, 'kind': 'isbn', 'borrowing': borrowing, 'updated': False})
+                targets.append(borrowing)
+
+        seen = set()
+        changed = []
+        for entry, borrowing in zip(report, targets):
+            if borrowing is None:
+                entry['result'] = "No open loan for this ISBN" if entry['kind'] == 'isbn' else "Not found"
+            elif borrowing.id in seen:
+                entry['result'] = "Duplicate"
+            elif borrowing.returned_date is not None or borrowing.status == 'RETURNED':
+                entry['result'] = "Already returned"
+            elif borrowing.status == new_status:
+                entry['result'] = f"Already {new_status.lower()}"
+            else:
+                entry['result'] = f"Updated to {new_status.lower()}"
+                entry['updated'] = True
+                changed.append(borrowing)
+            if borrowing is not None:
+                seen.add(borrowing.id)
+
+        if not changed:
+            return report
+
+        if new_status != 'RETURNED':
+            Borrowing.objects.filter(id__in=[b.id for b in changed]).update(status=new_status)
+        else:
+            policies = load_policies()
+            charges = []
+            for borrowing in changed:
+                borrowing.status = 'RETURNED'
+                borrowing.returned_date = now
+                borrowing.late_fee = compute_fee(borrowing.due_date, now, policy_for(borrowing.book.genre, policies))
+                if borrowing.late_fee > 0:
+                    charges.append(FeeLedgerEntry(
+                        user_id=borrowing.user_id, borrowing=borrowing, entry_type='CHARGE',
+                        amount=borrowing.late_fee, note=f"Late return of {borrowing.book.title}",
+                    ))
+            Borrowing.objects.bulk_update(changed, ['status', 'returned_date', 'late_fee'])
+            FeeLedgerEntry.objects.bulk_create(charges)
+
+            # Copies back on the shelf: tracked copies are flipped and their
+            # books recounted; untracked books get one grouped count and one UPDATE
+            copy_ids = [b.copy_id for b in changed if b.copy_id]
+            if copy_ids:
+                Copy.objects.filter(id__in=copy_ids).update(status='AVAILABLE')
+                sync_availability({b.book_id for b in changed if b.copy_id})
+            returned = (
+                Borrowing.objects.filter(id__in=[b.id for b in changed if not b.copy_id])
+                .values('book').annotate(n=Count('id')).order_by()
+            )
+            increments = {row['book']: row['n'] for row in returned}
+            if increments:
+                Book.objects.filter(id__in=increments).update(available_copies=Case(
+                    *[When(id=book_id, then=F('available_copies') + n) for book_id, n in increments.items()],
+                    default=F('available_copies'),
+                    output_field=PositiveIntegerField(),
+                ))
+
+        affected_users = {b.user_id for b in changed}
+        affected_books = {b.book_id for b in changed}
+
+        def drop_cached():
+            for user_id in affected_users:
+                invalidate(user_id=user_id)
+            for book_id in affected_books:
+                invalidate(book_id=book_id)
+        transaction.on_commit(drop_cached)
+    return report
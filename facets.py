@@ -0,0 +1,189 @@
+from collections import Counter
+
+from django.db.models import BooleanField, Count, ExpressionWrapper, F, FloatField, Q, Value
+from django.db.models.functions import Cast, Coalesce, ExtractYear, Floor, NullIf
+
+from .models import Book, rating_totals
+
+# Faceted browsing for book_list. Values within a facet are ORed, facets are
+# ANDed, and every facet's counts come from one grouped query over the
+# search results: rows are grouped by all facet columns at once and each
+# facet is counted in Python with the other facets' filters applied, so
+# selecting more filters does not add queries.
+FACETS = ['genre', 'category', 'decade', 'available', 'rating']
+RATING_THRESHOLDS = [4, 3, 2, 1]
+
+
+def parse_filters(params):
+    """Selected facet values from the query string; unknown values are dropped"""
+    genres = dict(Book.GENRE_CHOICES)
+    by_label = {label.lower(): code for code, label in Book.GENRE_CHOICES}
+    selected_genres = []
+    for value in params.getlist('genre'):
+        # Accept codes in any case and with dashes (home.html links ?genre=non-fiction)
+        code = value.strip().upper().replace('-', '_')
+        code = code if code in genres else by_label.get(value.strip().lower())
+        if code and code not in selected_genres:
+            selected_genres.append(code)
+
+    decades = []
+    for value in params.getlist('decade'):
+        if value.isdigit() and int(value) % 10 == 0:
+            decades.append(int(value))
+
+    rating = params.get('rating', '')
+    return {
+        'genre': selected_genres,
+        'category': [value.strip() for value in params.getlist('category') if value.strip()],
+        'decade': decades,
+        'available': params.get('available') == '1',
+        'rating': int(rating) if rating.isdigit() and int(rating) in RATING_THRESHOLDS else None,
+    }
+
+
+def _rating_floor():
+    """Whole stars of the average rating, 0 for unrated books; needs rating_totals() annotations"""
+    return Coalesce(
+        Floor(Cast('rating_total', FloatField()) / NullIf('rating_votes', 0)),
+        Value(0.0), output_field=FloatField(),
+    )
+
+
+def apply_filters(books, filters):
+    """Narrow a Book queryset to the selected facet values"""
+    if filters['genre']:
+        books = books.filter(genre__in=filters['genre'])
+    if filters['category']:
+        q = Q()
+        for category in filters['category']:
+            q |= Q(category__iexact=category)
+        books = books.filter(q)
+    if filters['decade']:
+        q = Q()
+        for decade in filters['decade']:
+            q |= Q(published_date__year__gte=decade, published_date__year__lt=decade + 10)
+        books = books.filter(q)
+    if filters['available']:
+        books = books.filter(available_copies__gt=0)
+    if filters['rating']:
+        books = books.annotate(**rating_totals()).filter(
+            rating_votes__gt=0, rating_total__gte=F('rating_votes') * filters['rating'])
+    return books
+
+
+def facet_rows(books):
+    """The grouped query: one row per combination of facet values, with its book count"""
+    if 'rating_total' not in books.query.annotations:
+        books = books.annotate(**rating_totals())
+    return (
+        books.annotate(
+            decade=Floor(ExtractYear('published_date') / 10) * 10,
+            in_stock=ExpressionWrapper(Q(available_copies__gt=0), output_field=BooleanField()),
+            rating_floor=_rating_floor(),
+        )
+        .values('genre', 'category', 'decade', 'in_stock', 'rating_floor')
+        .annotate(n=Count('id'))
+        .order_by()
+    )
+
+
+def _row_values(row):
+    return {
+        'genre': row['genre'],
+        'category': row['category'],
+        'decade': int(row['decade']),
+        'available': bool(row['in_stock']),
+        'rating': int(row['rating_floor']),
+    }
+
+
+def _matches(values, filters, skip):
+    """Whether a row passes every selected facet filter except the skip facet's own"""
+    if skip != 'genre' and filters['genre'] and values['genre'] not in filters['genre']:
+        return False
+    if (skip != 'category' and filters['category']
+            and values['category'].lower() not in {c.lower() for c in filters['category']}):
+        return False
+    if skip != 'decade' and filters['decade'] and values['decade'] not in filters['decade']:
+        return False
+    if skip != 'available' and filters['available'] and not values['available']:
+        return False
+    if skip != 'rating' and filters['rating'] and values['rating'] < filters['rating']:
+        return False
+    return True
+
+
+def count_facets(rows, filters):
+    """Counter of books per value for each facet, from the grouped rows"""
+    counts = {facet: Counter() for facet in FACETS}
+    for row in rows:
+        values = _row_values(row)
+        for facet in FACETS:
+            if _matches(values, filters, facet):
+                counts[facet][values[facet]] += row['n']
+    # Ratings are "N stars & up", so each threshold includes the buckets above it
+    by_bucket = counts['rating']
+    counts['rating'] = Counter({
+        threshold: sum(n for bucket, n in by_bucket.items() if bucket >= threshold)
+        for threshold in RATING_THRESHOLDS
+    })
+    return counts
+
+
+def _toggle_url(query, facet, value, multiple=True):
+    """Query string with one facet value switched on or off"""
+    query = query.copy()
+    current = query.getlist(facet)
+    kept = [v for v in current if v.lower() != str(value).lower()]
+    if len(kept) == len(current):
+        kept = kept + [str(value)] if multiple else [str(value)]
+    query.setlist(facet, kept)
+    return '?' + query.urlencode()
+
+
+def build_facets(params, counts, filters):
+    """Facet groups for the template: options with counts, selection state and toggle links"""
+    genres = dict(Book.GENRE_CHOICES)
+    categories = list(counts['category'])
+    known = {c.lower() for c in categories}
+    categories += [c for c in filters['category'] if c.lower() not in known]  # Keep selections removable
+    groups = [
+        ('genre', 'Genre', [(code, genres[code]) for code, _ in Book.GENRE_CHOICES], True),
+        ('category', 'Category', [(c, c) for c in sorted(categories, key=str.lower)], True),
+        ('decade', 'Published', [(d, f"{d}s") for d in sorted(counts['decade'], reverse=True)], True),
+        ('available', 'Availability', [(True, "Available now")], False),
+        ('rating', 'Rating', [(t, f"{t}★ & up") for t in RATING_THRESHOLDS], False),
+    ]
+    selected_categories = {c.lower() for c in filters['category']}
+    # Links start from the parsed selection, so aliases such as ?genre=fiction toggle cleanly
+    query = params.copy()
+    query.setlist('genre', filters['genre'])
+    query.setlist('decade', [str(d) for d in filters['decade']])
+    query.setlist('available', ['1'] if filters['available'] else [])
+    query.setlist('rating', [str(filters['rating'])] if filters['rating'] else [])
+    facets = []
+    for name, label, values, multiple in groups:
+        options = []
+        for value, option_label in values:
+            if name == 'category':
+                selected = value.lower() in selected_categories
+            elif name == 'available':
+                selected = filters['available']
+            elif name == 'rating':
+                selected = filters['rating'] == value
+            else:
+                selected = value in filters[name]
+            count = counts[name][value]
+            if not count and not selected:
+                continue
+            param_value = 1 if name == 'available' else value
+            options.append({
+                'value': value,
+                'label': option_label,
+                'count': count,
+                'selected': selected,
+                'url': _toggle_url(query, name, param_value, multiple),
+            })
+        if options:
+            facets.append({'name': name, 'label': label, 'options': options})
+    return facets
@@ -0,0 +1,137 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, Q, Sum, Value, When
+from django.utils import timezone
+
+from .models import Borrowing, FeeLedgerEntry, FeePolicy
+
+# Used for genres that have no FeePolicy row
+DEFAULT_POLICY = FeePolicy(daily_rate=Decimal('0.50'), grace_days=0, max_fee=None)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def load_policies():
+    """All fee policies keyed by genre (the table holds at most one row per genre)"""
+    return {policy.genre: policy for policy in FeePolicy.objects.all()}
+
+
+def policy_for(genre, policies=None):
+    if policies is None:
+        return FeePolicy.objects.filter(genre=genre).first() or DEFAULT_POLICY
+    return policies.get(genre, DEFAULT_POLICY)
+
+
+def compute_fee(due_date, until, policy):
+    """Late fee for a loan due at due_date and returned (or still out) at until"""
+    days = (until - due_date).days - policy.grace_days
+    if days <= 0:
+        return Decimal('0.00')
+    fee = Decimal(days) * policy.daily_rate
+    if policy.max_fee is not None:
+        fee = min(fee, policy.max_fee)
+    return fee.quantize(Decimal('0.01'))
+
+
+def open_loans():
+    """Loans that are still out, whatever status the row currently has"""
+    return Borrowing.objects.filter(returned_date__isnull=True, status__in=['BORROWED', 'OVERDUE'])
+
+
+def settle_return(borrowing, returned_at=None):
+    """
+    Finalise the late fee of a loan being returned and post it to the ledger.
+
+    The caller saves the borrowing; the ledger charge is only written if
+    there is a fee to charge.
+    """
+    borrowing.returned_date = returned_at or borrowing.returned_date or timezone.now()
+    borrowing.late_fee = compute_fee(borrowing.due_date, borrowing.returned_date, policy_for(borrowing.book.genre))
+    if borrowing.late_fee > 0:
+        FeeLedgerEntry.objects.create(
+            user_id=borrowing.user_id,
+            borrowing=borrowing,
+            entry_type='CHARGE',
+            amount=borrowing.late_fee,
+            note=f"Late return of {borrowing.book.title}",
+        )
+    return borrowing.late_fee
+
+
+def user_balance(user):
+    """Outstanding ledger balance: charges minus payments and waivers"""
+    totals = FeeLedgerEntry.objects.filter(user=user).aggregate(
+        charged=Sum('amount', filter=Q(entry_type='CHARGE')),
+        credited=Sum('amount', filter=~Q(entry_type='CHARGE')),
+    )
+    return (totals['charged'] or Decimal('0.00')) - (totals['credited'] or Decimal('0.00'))
+
+
+def accrue_open_fees(now=None, chunk_size=10000):
+    """
+    Recompute the accrued late fee of every open loan in one pass.
+
+    Fees are computed with NumPy over arrays of due dates (in integer cents, so
+    there is no float rounding), then written back with one UPDATE per chunk
+    using a CASE over the distinct amounts, so the number of statements does
+    not grow with the number of loans. Loans past their due date are also
+    flagged OVERDUE. Returns (loans updated, loans flagged overdue).
+    """
+    import numpy as np
+
+    now = now or timezone.now()
+    policies = load_policies()
+    genres = [genre for genre, _ in FeePolicy._meta.get_field('genre').choices]
+    genre_index = {genre: i for i, genre in enumerate(genres)}
+    # One slot per genre plus a final slot (len(genres)) for unknown genres
+    resolved = [policy_for(genre, policies) for genre in genres] + [DEFAULT_POLICY]
+    no_cap = np.iinfo(np.int64).max
+    rate_cents = np.array([int(p.daily_rate * 100) for p in resolved], dtype=np.int64)
+    grace_days = np.array([p.grace_days for p in resolved], dtype=np.int64)
+    cap_cents = np.array([no_cap if p.max_fee is None else int(p.max_fee * 100) for p in resolved], dtype=np.int64)
+
+    with transaction.atomic():
+        flagged = open_loans().filter(status='BORROWED', due_date__lt=now).update(status='OVERDUE')
+
+        # Walk the open loans in id order, one chunk per query, rather than
+        # holding a cursor open on the table we are updating
+        updated = 0
+        last_id = 0
+        while True:
+            chunk = list(
+                open_loans().filter(due_date__lt=now, id__gt=last_id)
+                .order_by('id')
+                .values_list('id', 'due_date', 'book__genre', 'late_fee')[:chunk_size]
+            )
+            if not chunk:
+                break
+            updated += _accrue_chunk(np, chunk, now, genre_index, rate_cents, grace_days, cap_cents)
+            last_id = chunk[-1][0]
+    return updated, flagged
+
+
+def _accrue_chunk(np, chunk, now, genre_index, rate_cents, grace_days, cap_cents):
+    ids = np.array([row[0] for row in chunk], dtype=np.int64)
+    due = np.array([row[1].timestamp() for row in chunk])
+    genre = np.array([genre_index.get(row[2], len(genre_index)) for row in chunk], dtype=np.int64)
+    current = np.array([int(row[3] * 100) for row in chunk], dtype=np.int64)
+
+    days = np.floor((now.timestamp() - due) / SECONDS_PER_DAY).astype(np.int64) - grace_days[genre]
+    fee = np.minimum(np.maximum(days, 0) * rate_cents[genre], cap_cents[genre])
+
+    changed = fee != current
+    if not changed.any():
+        return 0
+    by_amount = defaultdict(list)
+    for loan_id, cents in zip(ids[changed].tolist(), fee[changed].tolist()):
+        by_amount[cents].append(loan_id)
+
+    fee_field = DecimalField(max_digits=6, decimal_places=2)
+    Borrowing.objects.filter(id__in=ids[changed].tolist()).update(late_fee=Case(
+        *[When(id__in=loan_ids, then=Value(Decimal(cents) / 100, output_field=fee_field))
+          for cents, loan_ids in by_amount.items()],
+        output_field=fee_field,
+    ))
+    return int(changed.sum())
@@ -4,6 +4,9 @@ from django.utils import timezone
 from datetime import timedelta
 
 class Bookform(forms.ModelForm):
+    # For books circulated by copy: register this many new copies on save
+    new_copies = forms.IntegerField(min_value=0, max_value=100, required=False, initial=0)
+
     class Meta:
         model = Book
         fields = '__all__'
@@ -11,6 +14,15 @@ class Bookform(forms.ModelForm):
             'published_date': forms.DateInput(attrs={'type': 'date'}),
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tracks_copies = bool(self.instance.pk) and self.instance.copies.exists()
+        if self.tracks_copies:
+            # Counted from the copies' state; a typed value would be lost at the next recount
+            self.fields['available_copies'].disabled = True
+        else:
+            del self.fields['new_copies']
+
 class ReviewForm(forms.ModelForm):
     class Meta:
         model = Review
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...fees import accrue_open_fees
+
+
+class Command(BaseCommand):
+    help = 'Recompute accrued late fees for all open loans and flag overdue ones (run nightly)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Loans processed per query')
+
+    def handle(self, *args, **options):
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            raise CommandError("accrue_late_fees requires numpy (pip install numpy).")
+
+        updated, flagged = accrue_open_fees(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Updated fees on {updated} loans; {flagged} newly overdue."))
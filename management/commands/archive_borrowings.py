@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from ...archival import archive_cutoff, archive_returned
+
+
+class Command(BaseCommand):
+    help = 'Move old returned loans from Borrowing into the archive table (run nightly, after refresh_analytics)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            help='Archive loans returned more than this many days ago '
+                                 '(default: BORROWING_ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Loans moved per transaction')
+
+    def handle(self, *args, **options):
+        after = timedelta(days=options['days']) if options['days'] is not None else None
+        cutoff = archive_cutoff(after=after)
+        if cutoff is None:
+            self.stdout.write(self.style.WARNING(
+                "Nothing archived: run refresh_analytics first, loans are only archived once rolled up."))
+            return
+        archived = archive_returned(cutoff, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Archived {archived} loans returned before {cutoff:%Y-%m-%d %H:%M}."))
@@ -0,0 +1,92 @@
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+async def worker(host, port, request_bytes, deadline, latencies, errors):
+    """Send keep-alive GET requests on one connection until the deadline"""
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            start = time.perf_counter()
+            writer.write(request_bytes)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            await reader.readexactly(int(headers.get('content-length', 0)))
+            latencies.append(time.perf_counter() - start)
+
+            if not status_line.split(b' ')[1].startswith((b'2', b'3')):
+                errors.append(status_line.decode('latin-1').strip())
+            if headers.get('connection', '').lower() == 'close':
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError, IndexError, ValueError) as e:
+            errors.append(str(e))
+            if writer is not None:
+                writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def run(url, concurrency, duration, cookie):
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    request = f'GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nConnection: keep-alive\r\n'
+    if cookie:
+        request += f'Cookie: {cookie}\r\n'
+    request_bytes = (request + '\r\n').encode('latin-1')
+
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[
+        worker(parts.hostname, parts.port or 80, request_bytes, deadline, latencies, errors)
+        for _ in range(concurrency)
+    ])
+    return latencies, errors
+
+
+class Command(BaseCommand):
+    help = 'Load a running deployment with keep-alive GET requests and report throughput and latency'
+    # Measures a server started separately; this process needs no database
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='e.g. http://127.0.0.1:8000/library/books/')
+        parser.add_argument('-c', '--concurrency', type=int, default=100, help='Open connections')
+        parser.add_argument('-d', '--duration', type=float, default=10.0, help='Seconds to run')
+        parser.add_argument('--cookie', default='', help='Raw Cookie header, e.g. "sessionid=..."')
+
+    def handle(self, *args, **options):
+        if urlsplit(options['url']).scheme != 'http':
+            raise CommandError("Only plain http:// URLs are supported.")
+        concurrency, duration = options['concurrency'], options['duration']
+        latencies, errors = asyncio.run(run(options['url'], concurrency, duration, options['cookie']))
+        if not latencies:
+            raise CommandError(f"No successful requests ({len(errors)} errors).")
+
+        ms = sorted(latency * 1000 for latency in latencies)
+        self.stdout.write(f"URL:          {options['url']}")
+        self.stdout.write(f"Concurrency:  {concurrency}")
+        self.stdout.write(f"Requests:     {len(ms)} ({len(errors)} errors)")
+        self.stdout.write(f"Throughput:   {len(ms) / duration:.1f} req/s")
+        self.stdout.write(f"Latency mean: {statistics.mean(ms):.1f} ms")
+        self.stdout.write(f"Latency p50:  {ms[len(ms) // 2]:.1f} ms")
+        self.stdout.write(f"Latency p99:  {ms[min(len(ms) - 1, int(len(ms) * 0.99))]:.1f} ms")
@@ -0,0 +1,101 @@
+from itertools import chain
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...models import BookRecommendation, Borrowing, ReturnedBook, Review
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the "readers who borrowed this also borrowed" recommendations for every book'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=5, help='Neighbours stored per book')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Books whose similarities are computed at a time')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Rows fetched from / written to the database at a time')
+
+    def handle(self, *args, **options):
+        try:
+            import numpy as np
+            from scipy import sparse
+        except ImportError:
+            raise CommandError("build_recommendations requires numpy and scipy (pip install numpy scipy).")
+
+        top_k = options['top_k']
+        chunk_size = options['chunk_size']
+        batch_size = options['batch_size']
+
+        # Borrow history counts once per (user, book); a review adds a
+        # rating-dependent weight so well-liked co-reads score higher.
+        borrows = np.unique(np.concatenate([
+            self._fetch_pairs(np, Borrowing.objects.values_list('user_id', 'book_id').distinct(), 2, batch_size),
+            self._fetch_pairs(np, ReturnedBook.objects.values_list('user_id', 'book_id'), 2, batch_size),
+        ]), axis=0)  # Archived loans are summarised per (user, book); a pair may be in both tables
+        reviews = self._fetch_pairs(
+            np, Review.objects.filter(status='APPROVED').values_list('user_id', 'book_id', 'rating'), 3, batch_size)
+
+        user_ids = np.concatenate([borrows[:, 0], reviews[:, 0]])
+        book_ids = np.concatenate([borrows[:, 1], reviews[:, 1]])
+        weights = np.concatenate([
+            np.ones(len(borrows)),
+            (reviews[:, 2] - 3) / 2.0,  # 1 star -> -1.0, 5 stars -> +1.0
+        ])
+        if len(user_ids) == 0:
+            self.stdout.write("No borrowing or review history; nothing to do.")
+            return
+
+        users, user_index = np.unique(user_ids, return_inverse=True)
+        books, book_index = np.unique(book_ids, return_inverse=True)
+
+        # users x books interaction matrix; duplicate entries are summed
+        interactions = sparse.csr_matrix(
+            (weights, (user_index, book_index)), shape=(len(users), len(books)))
+        interactions.data = np.clip(interactions.data, 0, None)
+        interactions.eliminate_zeros()
+
+        # Cosine similarity: scale every book column to unit length so
+        # X.T @ X gives the similarity directly.
+        norms = np.sqrt(np.asarray(interactions.multiply(interactions).sum(axis=0))).ravel()
+        norms[norms == 0] = 1.0
+        normalized = sparse.csc_matrix(interactions.multiply(1.0 / norms))
+        normalized_t = normalized.T.tocsr()
+
+        stored = 0
+        with transaction.atomic():
+            BookRecommendation.objects.all().delete()
+            for start in range(0, len(books), chunk_size):
+                stop = min(start + chunk_size, len(books))
+                # Only chunk x books similarities are held in memory at a time
+                similarities = (normalized_t[start:stop] @ normalized).tocsr()
+                recommendations = []
+                for row in range(stop - start):
+                    begin, end = similarities.indptr[row], similarities.indptr[row + 1]
+                    columns = similarities.indices[begin:end]
+                    scores = similarities.data[begin:end]
+                    keep = (columns != start + row) & (scores > 0)
+                    columns, scores = columns[keep], scores[keep]
+                    if len(scores) > top_k:
+                        best = np.argpartition(-scores, top_k)[:top_k]
+                        columns, scores = columns[best], scores[best]
+                    order = np.argsort(-scores, kind='stable')
+                    book_id = int(books[start + row])
+                    for rank, position in enumerate(order, start=1):
+                        recommendations.append(BookRecommendation(
+                            book_id=book_id,
+                            recommended_book_id=int(books[columns[position]]),
+                            score=float(scores[position]),
+                            rank=rank,
+                        ))
+                BookRecommendation.objects.bulk_create(recommendations, batch_size=batch_size)
+                stored += len(recommendations)
+                self.stdout.write(f"Scored books {start + 1}-{stop} of {len(books)}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {stored} recommendations for {len(books)} books."))
+
+    def _fetch_pairs(self, np, queryset, width, batch_size):
+        """Stream a values_list queryset into an (n, width) integer array"""
+        rows = queryset.order_by().iterator(chunk_size=batch_size)
+        return np.fromiter(chain.from_iterable(rows), dtype=np.int64).reshape(-1, width)
@@ -0,0 +1,58 @@
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from ... import circulation
+from ...fees import open_loans
+from ...models import Book, Borrowing
+
+
+class Command(BaseCommand):
+    help = 'Compare the cached loan states and book availability with the database and report drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Drop drifted entries so they reload from the database')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        drifted = 0
+
+        # Book availability
+        book_ids = list(Book.objects.order_by('id').values_list('id', flat=True))
+        for start in range(0, len(book_ids), batch_size):
+            batch = book_ids[start:start + batch_size]
+            cached = cache.get_many([circulation.availability_key(book_id) for book_id in batch])
+            if not cached:
+                continue
+            actual = dict(Book.objects.filter(id__in=batch).values_list('id', 'available_copies'))
+            for book_id in batch:
+                key = circulation.availability_key(book_id)
+                if key in cached and cached[key] != actual.get(book_id):
+                    drifted += 1
+                    self.stdout.write(f"Book {book_id}: cached {cached[key]} available, database {actual.get(book_id)}")
+                    if options['fix']:
+                        circulation.invalidate(book_id=book_id)
+
+        # Per-user loan states
+        user_ids = list(Borrowing.objects.order_by('user_id').values_list('user_id', flat=True).distinct())
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            cached = cache.get_many([circulation.loan_state_key(user_id) for user_id in batch])
+            if not cached:
+                continue
+            actual = {user_id: [] for user_id in batch}
+            for user_id, book_id in open_loans().filter(user_id__in=batch).values_list('user_id', 'book_id'):
+                actual[user_id].append(book_id)
+            for user_id in batch:
+                key = circulation.loan_state_key(user_id)
+                if key in cached and sorted(cached[key]) != sorted(actual[user_id]):
+                    drifted += 1
+                    self.stdout.write(f"User {user_id}: cached loans {cached[key]}, database {sorted(actual[user_id])}")
+                    if options['fix']:
+                        circulation.invalidate(user_id=user_id)
+
+        if drifted:
+            action = "dropped" if options['fix'] else "found"
+            self.stdout.write(self.style.WARNING(f"{drifted} drifted cache entries {action}."))
+        else:
+            self.stdout.write(self.style.SUCCESS("Circulation cache is consistent with the database."))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+
+from ... import circulation
+from ...models import Book, Copy
+
+
+class Command(BaseCommand):
+    help = 'Create barcoded copies for books that only have an available_copies count (run once after migrating)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Books converted per transaction')
+        parser.add_argument('--recount', action='store_true',
+                            help='Also recount available_copies from copy state for every book with copies')
+
+    def handle(self, *args, **options):
+        untracked = Book.objects.exclude(Exists(Copy.objects.filter(book=OuterRef('pk')))).order_by('id')
+        books = created = 0
+        last_id = 0
+        while True:
+            batch = list(untracked.filter(id__gt=last_id).only('id', 'isbn', 'available_copies')[:options['batch_size']])
+            if not batch:
+                break
+            created += circulation.copies_from_counts(batch)
+            books += len(batch)
+            last_id = batch[-1].id
+        self.stdout.write(self.style.SUCCESS(f"Created {created} copies for {books} books."))
+
+        if options['recount']:
+            recounted = circulation.sync_availability()
+            self.stdout.write(self.style.SUCCESS(f"Recounted availability of {recounted} books."))
+            self.stdout.write("Run check_circulation_cache --fix to drop any cached availability the recount changed.")
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from ...reviews import approve_clean, fold_rating_deltas, rebuild_rating_stats
+
+
+class Command(BaseCommand):
+    help = 'Approve unflagged pending reviews and fold rating changes into book totals (run from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Reviews approved per transaction')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Recompute all rating totals from the approved reviews instead')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            books = rebuild_rating_stats()
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt rating totals for {books} books."))
+            return
+        approved = approve_clean(options['chunk_size'])
+        books = fold_rating_deltas()
+        self.stdout.write(self.style.SUCCESS(f"Approved {approved} reviews; updated rating totals for {books} books."))
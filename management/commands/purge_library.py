@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from ... import seeding
+
+
+class Command(BaseCommand):
+    help = 'Delete the synthetic data created by seed_library, optionally archiving it first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--archive', metavar='PATH',
+                            help='Write the seeded rows to a JSON Lines fixture (loaddata can restore it) first')
+        parser.add_argument('--vacuum', action='store_true', help='Reclaim the freed disk space afterwards')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Books or users deleted per transaction')
+
+    def handle(self, *args, **options):
+        log = self.stdout.write if options['verbosity'] > 1 else None
+        if options['archive']:
+            with open(options['archive'], 'w', encoding='utf-8') as stream:
+                seeding.archive(stream, options['batch_size'])
+            self.stdout.write(f"Archived seeded data to {options['archive']}.")
+
+        books, users = seeding.purge(options['batch_size'], log)
+        self.stdout.write(self.style.SUCCESS(f"Deleted {books} seeded books and {users} seeded users."))
+
+        if options['vacuum']:
+            seeding.vacuum()
+            self.stdout.write("Reclaimed free space.")
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ...analytics import refresh_rollups
+
+
+class Command(BaseCommand):
+    help = 'Fold new borrowings and reviews into the daily analytics rollups (run from cron)'
+
+    def handle(self, *args, **options):
+        touched = refresh_rollups()
+        self.stdout.write(self.style.SUCCESS(f"Updated {touched} daily rollup rows."))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...seeding import SEED_PASSWORD, SEED_USERNAME_PREFIX, Seeder
+
+
+class Command(BaseCommand):
+    help = 'Generate a large synthetic library (books, readers, loans, reviews) for performance testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=10000)
+        parser.add_argument('--users', type=int, default=5000)
+        parser.add_argument('--borrowings', type=int, default=100000)
+        parser.add_argument('--seed', type=int, default=42, help='Same seed and sizes give the same data')
+        parser.add_argument('--days', type=int, default=730, help='History covered by the loans')
+        parser.add_argument('--overdue-rate', type=float, default=0.08,
+                            help='Share of past-due loans that are still out')
+        parser.add_argument('--review-rate', type=float, default=0.3, help='Share of returned loans reviewed')
+        parser.add_argument('--zipf', type=float, default=1.1, help='Exponent of the book popularity distribution')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows inserted per transaction')
+
+    def handle(self, *args, **options):
+        if options['books'] < 1 or options['users'] < 1:
+            raise CommandError("--books and --users must be at least 1.")
+        seeder = Seeder(
+            seed=options['seed'],
+            batch_size=options['batch_size'],
+            days=options['days'],
+            overdue_rate=options['overdue_rate'],
+            review_rate=options['review_rate'],
+            zipf_exponent=options['zipf'],
+            log=self.stdout.write if options['verbosity'] > 1 else None,
+        )
+        created = seeder.run(options['books'], options['users'], options['borrowings'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {created['books']} books, {created['users']} users, "
+            f"{created['borrowings']} borrowings and {created['reviews']} reviews."))
+        self.stdout.write(f"Seeded users are named {SEED_USERNAME_PREFIX}00000001 and up; "
+                          f"their password is '{SEED_PASSWORD}'. Remove them with purge_library.")
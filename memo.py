@@ -0,0 +1,61 @@
+import contextvars
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.utils import timezone
+from django.utils.decorators import sync_and_async_middleware
+
+# One "now" per request, so every row of a table is judged against the same
+# instant and timezone.now() is not called for every property access.
+_request_now = contextvars.ContextVar('library_request_now', default=None)
+
+
+def now():
+    """The current request's time snapshot, or the real time outside a request"""
+    snapshot = _request_now.get()
+    return snapshot if snapshot is not None else timezone.now()
+
+
+@sync_and_async_middleware
+def request_memo_middleware(get_response):
+    """Take the per-request time snapshot used by memo.now()"""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            token = _request_now.set(timezone.now())
+            try:
+                return await get_response(request)
+            finally:
+                _request_now.reset(token)
+    else:
+        def middleware(request):
+            token = _request_now.set(timezone.now())
+            try:
+                return get_response(request)
+            finally:
+                _request_now.reset(token)
+    return middleware
+
+
+def memoized(*depends_on):
+    """
+    Cache a model method's result on the instance for the current request.
+
+    The cache key is the request's time snapshot plus the given attributes,
+    so a result is reused only while none of its inputs have changed. Outside
+    a request there is no snapshot and the method is always re-evaluated.
+    """
+    def decorator(method):
+        name = method.__name__
+
+        @wraps(method)
+        def wrapper(self):
+            snapshot = _request_now.get()
+            if snapshot is None:
+                return method(self)
+            key = (name, snapshot) + tuple(getattr(self, attr) for attr in depends_on)
+            memo = self.__dict__.setdefault('_memo', {})
+            if key not in memo:
+                memo[key] = method(self)
+            return memo[key]
+        return wrapper
+    return decorator
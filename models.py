@@ -1,19 +1,23 @@
 from django.db import models
 from django.contrib.auth.models import User
-from django.utils import timezone
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
 from decimal import Decimal
-from datetime import timedelta
+from .memo import memoized, now as request_now
+from .uploads import ImageUploadField
 
 # Create your models here.
 class Book(models.Model):
-    title = models.CharField(max_length=200)
-    author = models.CharField(max_length=200)
-    cover_pic = models.ImageField(upload_to='cover_pics/', blank=True)
+    # Indexed for prefix searches in the admin
+    title = models.CharField(max_length=200, db_index=True)
+    author = models.CharField(max_length=200, db_index=True)
+    cover_pic = ImageUploadField(upload_to='cover_pics/', blank=True)
     isbn = models.CharField(max_length=13, unique=True)
     description = models.TextField()
     category = models.CharField(max_length=50)
-    published_date = models.DateField()
+    published_date = models.DateField(db_index=True)
     available_copies = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)  # Read by the typeahead index
 
     # Add genre for search functionality
     GENRE_CHOICES = [
@@ -35,17 +39,30 @@ class Book(models.Model):
     def can_borrow(self):
         return self.available_copies > 0
     
+    # average_rating, rating_count and total_borrowed use the values annotated
+    # by the views or filled in by prefetch_book_stats() when present, and
+    # otherwise fall back to one query memoized for the request. Ratings come
+    # from the maintained rating totals (see rating_totals()), never from
+    # aggregating the reviews.
     @property
     def average_rating(self):
-        reviews = self.reviews.all()
-        if reviews:
-            total = sum([review.rating for review in reviews])
-            return round(total / len(reviews), 1)
-        return 0
+        if hasattr(self, 'avg_rating'):
+            return round(self.avg_rating, 1) if self.avg_rating is not None else 0
+        return self._rating_stats()['average']
     
     @property
     def rating_count(self):
-        return self.reviews.count()
+        if hasattr(self, 'num_reviews'):
+            return self.num_reviews
+        return self._rating_stats()['count']
+    
+    @memoized()
+    def _rating_stats(self):
+        total, count = (
+            Book.objects.filter(id=self.id).annotate(**rating_totals())
+            .values_list('rating_total', 'rating_votes').get()
+        )
+        return {'average': round(total / count, 1) if count else 0, 'count': count}
     
     def get_user_review(self, user):
         """Get user's review for this book if it exists"""
@@ -61,16 +78,48 @@ class Book(models.Model):
     @property
     def total_borrowed(self):
         """Get total number of times this book has been borrowed"""
-        return self.borrowings.count()
+        if hasattr(self, 'num_borrowings'):
+            return self.num_borrowings
+        return self._borrowing_count()
+    
+    @memoized()
+    def _borrowing_count(self):
+        return (Book.objects.filter(id=self.id).annotate(**borrowing_totals())
+                .values_list('num_borrowings', flat=True).get())
     
     def get_genre_display(self):
         """Get human-readable genre display"""
         return dict(self.GENRE_CHOICES).get(self.genre, self.genre)
 
+class Copy(models.Model):
+    """One physical copy of a book, identified by the barcode on its label.
+
+    Book.available_copies is kept equal to the number of AVAILABLE copies by
+    the circulation functions (see circulation.py).
+    """
+    STATUS_CHOICES = [
+        ('AVAILABLE', 'Available'),
+        ('ON_LOAN', 'On loan'),
+        ('LOST', 'Lost'),
+        ('WITHDRAWN', 'Withdrawn'),
+    ]
+    
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='copies')
+    barcode = models.CharField(max_length=32, unique=True)  # Unique index: a scan is one index lookup
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='AVAILABLE')
+    added_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        verbose_name_plural = 'copies'
+        indexes = [models.Index(fields=['book', 'status'])]  # Availability counts per book
+    
+    def __str__(self):
+        return f"{self.barcode} ({self.book.title})"
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     bio = models.TextField(blank=True)
-    profile_pic = models.ImageField(upload_to='profile_pics/', blank=True)
+    profile_pic = ImageUploadField(upload_to='profile_pics/', blank=True)
 
     def __str__(self):
         return f"{self.user.username}'s Profile"
@@ -85,41 +134,53 @@ class Borrowing(models.Model):
     ]
     
     book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='borrowings')
+    copy = models.ForeignKey(Copy, on_delete=models.SET_NULL, null=True, blank=True, related_name='borrowings')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='borrowings')
-    borrowed_date = models.DateTimeField(auto_now_add=True)
-    due_date = models.DateTimeField()
+    borrowed_date = models.DateTimeField(auto_now_add=True, db_index=True)
+    due_date = models.DateTimeField(db_index=True)
     returned_date = models.DateTimeField(null=True, blank=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='BORROWED')
     late_fee = models.DecimalField(max_digits=6, decimal_places=2, default=0.00)
     
+    archived = False  # See ArchivedBorrowing
+    
     def __str__(self):
         return f"{self.user.username} - {self.book.title} ({self.status})"
     
+    # The computed properties below are judged against the request's time
+    # snapshot and memoized per instance until status or due_date change.
+    @memoized('status', 'due_date')
     def is_overdue(self):
-        if self.status == 'BORROWED' and timezone.now() > self.due_date:
+        if self.status == 'BORROWED' and request_now() > self.due_date:
             return True
         return False
     
+    @memoized('status', 'due_date')
     def calculate_late_fee(self):
         if self.is_overdue():
-            days_overdue = (timezone.now() - self.due_date).days
-            return Decimal(days_overdue) * Decimal('0.50')  # $0.50 per day
+            from .fees import compute_fee, policy_for
+            return compute_fee(self.due_date, request_now(), policy_for(self.book.genre))
         return Decimal('0.00')
     
     # Property methods for templates
     @property
+    @memoized('status', 'due_date')
     def overdue_days(self):
         """Calculate number of overdue days"""
         if self.is_overdue():
-            days_overdue = (timezone.now() - self.due_date).days
+            days_overdue = (request_now() - self.due_date).days
             return max(0, days_overdue)
         return 0
     
+    # my_borrowings.html refers to the overdue day count by this name
+    days_overdue = overdue_days
+    
     @property
+    @memoized('status', 'due_date')
     def days_left(self):
         """Calculate days left until due date"""
         if self.status == 'BORROWED' and not self.is_overdue():
-            days_left = (self.due_date - timezone.now()).days
+            days_left = (self.due_date - request_now()).days
             return max(0, days_left)
         return 0
     
@@ -134,7 +195,65 @@ class Borrowing(models.Model):
             self.status = 'OVERDUE'
         super().save(*args, **kwargs)
 
+# Returned loans older than ARCHIVE_AFTER are moved out of Borrowing by
+# archival.archive_returned(), so the table the circulation pages scan only
+# holds open and recent loans.
+class ArchivedBorrowing(models.Model):
+    """A returned loan moved out of Borrowing; keeps the loan's original id"""
+    id = models.IntegerField(primary_key=True)
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='archived_borrowings')
+    copy = models.ForeignKey(Copy, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_borrowings')
+    borrowed_date = models.DateTimeField()
+    due_date = models.DateTimeField()
+    returned_date = models.DateTimeField(db_index=True)
+    late_fee = models.DecimalField(max_digits=6, decimal_places=2, default=0.00)
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    # Read like a returned Borrowing by the shared templates
+    status = 'RETURNED'
+    archived = True
+    overdue_days = 0
+    
+    class Meta:
+        indexes = [models.Index(fields=['user', '-returned_date'])]  # A reader's history, newest first
+    
+    def __str__(self):
+        return f"{self.user.username} - {self.book.title} (archived)"
+    
+    def is_overdue(self):
+        return False
+    
+    def get_status_display(self):
+        return 'Returned'
+
+class ReturnedBook(models.Model):
+    """
+    Compact summary of a reader's archived loans of one book.
+    
+    One row per (user, book) however many loans were archived; answers
+    "has this reader returned this book" for review eligibility and carries
+    the totals that history and count pages add to the live table's.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='returned_books')
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='returned_by')
+    loans = models.PositiveIntegerField(default=0)
+    late_fees = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
+    last_returned = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        unique_together = ['user', 'book']  # Also the eligibility lookup
+    
+    def __str__(self):
+        return f"{self.user.username} - {self.book.title} x{self.loans}"
+
 class Review(models.Model):
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending moderation'),
+        ('APPROVED', 'Approved'),
+        ('REJECTED', 'Rejected'),
+    ]
+    
     RATING_CHOICES = [
         (1, '1 Star - Poor'),
         (2, '2 Stars - Fair'),
@@ -147,8 +266,16 @@ class Review(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reviews')
     rating = models.IntegerField(choices=RATING_CHOICES)
     comment = models.TextField(max_length=500, blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Reviews submitted through the site start PENDING (see reviews.py)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='APPROVED', db_index=True)
+    flags = models.CharField(max_length=200, blank=True)  # Spam heuristics that held it for a moderator
+    moderated_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Rating currently included in the book's rating totals (None if not counted)
+    counted_rating = models.PositiveSmallIntegerField(null=True, blank=True, editable=False)
+    # Rating currently included in the daily analytics rollups (see analytics.py)
+    rolled_up_rating = models.PositiveSmallIntegerField(null=True, blank=True, editable=False)
     
     class Meta:
         unique_together = ['book', 'user']  # One review per user per book
@@ -156,10 +283,182 @@ class Review(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.book.title} ({self.rating} stars)"
     
+    def save(self, *args, **kwargs):
+        """Saving a loaded review never writes rolled_up_rating, which only the rollups update"""
+        if not self._state.adding and not args and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'rolled_up_rating'
+            ]
+        super().save(*args, **kwargs)
+    
     def get_rating_display(self):
         """Get human-readable rating display"""
         return dict(self.RATING_CHOICES).get(self.rating, f"{self.rating} Stars")
     
     def get_stars(self):
         """Get star representation of rating"""
-        return '★' * self.rating + '☆' * (5 - self.rating)
\ No newline at end of file
+        return '★' * self.rating + '☆' * (5 - self.rating)
+
+# Book rating totals are append-only: every change to what a review
+# contributes inserts a RatingDelta row, so concurrent reviews of one popular
+# book never wait on each other for a shared row. reviews.fold_rating_deltas()
+# periodically merges the deltas into BookRatingStats.
+class BookRatingStats(models.Model):
+    """Folded rating totals of a book's approved reviews"""
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True, related_name='rating_stats')
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        verbose_name_plural = 'book rating stats'
+    
+    def __str__(self):
+        return f"{self.book_id}: {self.rating_sum}/{self.rating_count}"
+
+class RatingDelta(models.Model):
+    """A not yet folded change to a book's rating totals"""
+    # No database constraint: a book's reviews are deleted (and withdraw their
+    # ratings) while the book itself is being deleted
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, db_constraint=False, related_name='+')
+    rating_sum = models.IntegerField()
+    rating_count = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    def __str__(self):
+        return f"{self.book_id}: {self.rating_sum:+d}/{self.rating_count:+d}"
+
+def rating_totals():
+    """Annotations giving a Book queryset its rating_total and rating_votes (folded plus pending)"""
+    pending = RatingDelta.objects.filter(book=OuterRef('pk')).order_by().values('book')
+    integer = models.IntegerField()
+    return {
+        'rating_total': Coalesce('rating_stats__rating_sum', 0, output_field=integer) + Coalesce(
+            Subquery(pending.annotate(total=Sum('rating_sum')).values('total')), 0, output_field=integer),
+        'rating_votes': Coalesce('rating_stats__rating_count', 0, output_field=integer) + Coalesce(
+            Subquery(pending.annotate(votes=Sum('rating_count')).values('votes')), 0, output_field=integer),
+    }
+
+def borrowing_totals():
+    """Annotation giving a Book queryset its num_borrowings, live plus archived loans"""
+    integer = models.IntegerField()
+    live = Borrowing.objects.filter(book=OuterRef('pk')).order_by().values('book').annotate(n=Count('id')).values('n')
+    archived = (ReturnedBook.objects.filter(book=OuterRef('pk')).order_by().values('book')
+                .annotate(n=Sum('loans')).values('n'))
+    return {
+        'num_borrowings': Coalesce(Subquery(live), 0, output_field=integer)
+        + Coalesce(Subquery(archived), 0, output_field=integer),
+    }
+
+def prefetch_book_stats(books):
+    """
+    Batch-load average_rating, rating_count and total_borrowed for many books.
+
+    Runs one grouped query per related table instead of one query per book and
+    property; returns the books so it can wrap a queryset.
+    """
+    books = list(books)
+    ids = [book.id for book in books]
+    ratings = {
+        book_id: {'average': total / votes if votes else None, 'count': votes}
+        for book_id, total, votes in Book.objects.filter(id__in=ids).annotate(**rating_totals())
+        .values_list('id', 'rating_total', 'rating_votes')
+    }
+    borrowed = dict(
+        Book.objects.filter(id__in=ids).annotate(**borrowing_totals()).values_list('id', 'num_borrowings')
+    )
+    for book in books:
+        row = ratings.get(book.id)
+        book.avg_rating = row['average'] if row else None
+        book.num_reviews = row['count'] if row else 0
+        book.num_borrowings = borrowed.get(book.id, 0)
+    return books
+
+class BookRecommendation(models.Model):
+    """Precomputed "readers who borrowed this also borrowed" neighbour of a book.
+
+    Rows are rebuilt offline by the build_recommendations command.
+    """
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='recommendations')
+    recommended_book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+    
+    class Meta:
+        ordering = ['rank']
+        unique_together = ['book', 'rank']  # Also the index used to look up a book's neighbours
+    
+    def __str__(self):
+        return f"{self.book.title} -> {self.recommended_book.title} ({self.score:.2f})"
+
+# Analytics rollups, maintained incrementally by analytics.refresh_rollups()
+class DailyRollup(models.Model):
+    """Per-day library activity for one genre/category pair"""
+    date = models.DateField()
+    genre = models.CharField(max_length=20, choices=Book.GENRE_CHOICES)
+    category = models.CharField(max_length=50)
+    borrows = models.PositiveIntegerField(default=0)
+    returns = models.PositiveIntegerField(default=0)
+    overdues = models.PositiveIntegerField(default=0)
+    late_fees_charged = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
+    # Net change on the day: a withdrawn approval counts negative
+    rating_sum = models.IntegerField(default=0)
+    rating_count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['date', 'genre', 'category']
+    
+    def __str__(self):
+        return f"{self.date} {self.genre}/{self.category}"
+    
+    @property
+    def average_rating(self):
+        if self.rating_count:
+            return round(self.rating_sum / self.rating_count, 1)
+        return 0
+
+class RollupWatermark(models.Model):
+    """Point in time up to which the rollups have been computed"""
+    name = models.CharField(max_length=50, unique=True)
+    processed_until = models.DateTimeField()
+    
+    def __str__(self):
+        return f"{self.name} @ {self.processed_until}"
+
+# Late-fee engine (see fees.py)
+class FeePolicy(models.Model):
+    """Late-fee rules for one genre; genres without a policy use the library default"""
+    genre = models.CharField(max_length=20, choices=Book.GENRE_CHOICES, unique=True)
+    daily_rate = models.DecimalField(max_digits=6, decimal_places=2, default=Decimal('0.50'))
+    grace_days = models.PositiveIntegerField(default=0)
+    max_fee = models.DecimalField(max_digits=8, decimal_places=2, null=True, blank=True)
+    
+    class Meta:
+        verbose_name_plural = 'fee policies'
+    
+    def __str__(self):
+        return f"{self.get_genre_display()}: ${self.daily_rate}/day"
+
+class FeeLedgerEntry(models.Model):
+    """A late-fee charge, payment or waiver on a patron's account"""
+    ENTRY_TYPES = [
+        ('CHARGE', 'Charge'),
+        ('PAYMENT', 'Payment'),
+        ('WAIVER', 'Waiver'),
+    ]
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='fee_entries')
+    borrowing = models.ForeignKey(Borrowing, on_delete=models.SET_NULL, null=True, blank=True, related_name='fee_entries')
+    # Set instead of borrowing once the loan is archived
+    archived_borrowing = models.ForeignKey(ArchivedBorrowing, on_delete=models.SET_NULL, null=True, blank=True,
+                                           related_name='fee_entries')
+    entry_type = models.CharField(max_length=10, choices=ENTRY_TYPES)
+    amount = models.DecimalField(max_digits=8, decimal_places=2)
+    note = models.CharField(max_length=200, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        verbose_name_plural = 'fee ledger entries'
+    
+    def __str__(self):
+        return f"{self.user.username} {self.entry_type} ${self.amount}"
\ No newline at end of file
@@ -0,0 +1,181 @@
+import re
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Sum, When
+from django.utils import timezone
+
+from .models import Book, BookRatingStats, RatingDelta, Review
+
+# Review write path: submissions are queued for moderation, spam heuristics
+# decide which ones need a human, and the rating totals that Book reads are
+# kept up to date through append-only RatingDelta rows folded in batches by
+# the process_reviews command.
+REVIEW_RATE_LIMIT = getattr(settings, 'REVIEW_RATE_LIMIT', 5)  # Reviews per user per window
+REVIEW_RATE_WINDOW = getattr(settings, 'REVIEW_RATE_WINDOW', 60 * 60)
+
+# Deltas committed slightly after their timestamp (long transactions) would be
+# deleted without being folded if we folded right up to "now", so stay behind.
+SETTLE_DELAY = timedelta(minutes=1)
+NEW_ACCOUNT_AGE = timedelta(days=1)
+
+_LINK = re.compile(r'https?://|www\.|\b[\w-]+\.(com|net|org|ru|xyz|info|biz)\b', re.IGNORECASE)
+_REPEATED = re.compile(r'(.)\1{5,}')
+
+
+def rate_limit_key(user_id):
+    return f'library:review_rate:{user_id}'
+
+
+def allow_review(user_id):
+    """Count a review submission against the user's window; False once the limit is used up"""
+    key = rate_limit_key(user_id)
+    cache.add(key, 0, REVIEW_RATE_WINDOW)
+    try:
+        count = cache.incr(key)
+    except ValueError:  # Expired between add() and incr()
+        cache.set(key, 1, REVIEW_RATE_WINDOW)
+        count = 1
+    return count <= REVIEW_RATE_LIMIT
+
+
+def spam_flags(review):
+    """Heuristics that hold a review for a moderator instead of automatic approval"""
+    flags = []
+    comment = review.comment.strip()
+    if _LINK.search(comment):
+        flags.append('link')
+    letters = [c for c in comment if c.isalpha()]
+    if len(letters) >= 20 and sum(c.isupper() for c in letters) > 0.7 * len(letters):
+        flags.append('shouting')
+    if _REPEATED.search(comment):
+        flags.append('repeated characters')
+    if comment and Review.objects.filter(user_id=review.user_id, comment=comment).exclude(pk=review.pk).exists():
+        flags.append('duplicate')
+    if (not comment and review.rating in (1, 5) and User.objects.filter(
+            id=review.user_id, date_joined__gte=timezone.now() - NEW_ACCOUNT_AGE).exists()):
+        flags.append('new account')
+    return flags
+
+
+def queue_for_moderation(review):
+    """
+    Save a new or edited review as PENDING.
+
+    An edited review that was approved stops counting towards the book's
+    rating until it is approved again.
+    """
+    review.status = 'PENDING'
+    review.flags = ', '.join(spam_flags(review))
+    review.moderated_at = None
+    review.save()
+
+
+def account(reviews):
+    """
+    Record the rating change of reviews whose counted rating is out of date.
+
+    Only approved reviews count. Called for every saved review (see signals)
+    and after bulk moderation; writes one bulk insert and one bulk update.
+    """
+    deltas = []
+    changed = []
+    for review in reviews:
+        target = review.rating if review.status == 'APPROVED' else None
+        if target == review.counted_rating:
+            continue
+        deltas.append(RatingDelta(
+            book_id=review.book_id,
+            rating_sum=(target or 0) - (review.counted_rating or 0),
+            rating_count=(target is not None) - (review.counted_rating is not None),
+        ))
+        review.counted_rating = target
+        changed.append(review)
+    if changed:
+        RatingDelta.objects.bulk_create(deltas)
+        Review.objects.bulk_update(changed, ['counted_rating'])
+    return len(changed)
+
+
+def moderate(reviews, status):
+    """Approve or reject reviews in bulk"""
+    now = timezone.now()
+    for review in reviews:
+        review.status = status
+        review.moderated_at = now
+    with transaction.atomic():
+        Review.objects.bulk_update(reviews, ['status', 'moderated_at'])
+        account(reviews)
+
+
+def approve_clean(chunk_size=1000):
+    """Approve pending reviews that raised no spam flags; returns how many"""
+    approved = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            chunk = list(
+                Review.objects.select_for_update().filter(status='PENDING', flags='', id__gt=last_id)
+                .order_by('id')[:chunk_size]
+            )
+            if not chunk:
+                break
+            moderate(chunk, 'APPROVED')
+        approved += len(chunk)
+        last_id = chunk[-1].id
+    return approved
+
+
+def fold_rating_deltas(until=None):
+    """
+    Merge settled rating deltas into BookRatingStats.
+
+    One grouped read, one insert for books without stats yet and one CASE
+    UPDATE per fold, however many reviews the deltas came from. Returns the
+    number of books whose totals changed.
+    """
+    until = until or timezone.now() - SETTLE_DELAY
+    with transaction.atomic():
+        settled = RatingDelta.objects.filter(created_at__lte=until)
+        totals = {
+            row['book']: row
+            for row in settled.values('book').annotate(total=Sum('rating_sum'), votes=Sum('rating_count')).order_by()
+            if row['total'] or row['votes']
+        }
+        # Deltas of deleted books are dropped with the rest
+        book_ids = set(Book.objects.filter(id__in=totals).values_list('id', flat=True))
+        BookRatingStats.objects.bulk_create(
+            [BookRatingStats(book_id=book_id) for book_id in book_ids], ignore_conflicts=True)
+        if book_ids:
+            integer = IntegerField()
+            BookRatingStats.objects.filter(book_id__in=book_ids).update(
+                rating_sum=Case(
+                    *[When(book_id=b, then=F('rating_sum') + totals[b]['total']) for b in book_ids],
+                    default=F('rating_sum'), output_field=integer),
+                rating_count=Case(
+                    *[When(book_id=b, then=F('rating_count') + totals[b]['votes']) for b in book_ids],
+                    default=F('rating_count'), output_field=integer),
+            )
+        settled.delete()
+    return len(book_ids)
+
+
+def rebuild_rating_stats():
+    """Recompute every book's totals from its approved reviews, e.g. after a bulk import"""
+    with transaction.atomic():
+        Review.objects.exclude(status='APPROVED').update(counted_rating=None)
+        Review.objects.filter(status='APPROVED').update(counted_rating=F('rating'))
+        totals = defaultdict(lambda: [0, 0])
+        for book_id, rating in Review.objects.filter(status='APPROVED').values_list('book_id', 'rating'):
+            totals[book_id][0] += rating
+            totals[book_id][1] += 1
+        RatingDelta.objects.all().delete()
+        BookRatingStats.objects.all().delete()
+        BookRatingStats.objects.bulk_create(
+            [BookRatingStats(book_id=book_id, rating_sum=s, rating_count=n) for book_id, (s, n) in totals.items()],
+            batch_size=1000)
+    return len(totals)
@@ -0,0 +1,331 @@
+import random
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.core import serializers
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .circulation import MAX_ACTIVE_LOANS, copies_from_counts
+from .fees import compute_fee, load_policies, policy_for
+from .models import (
+    ArchivedBorrowing, Book, BookRatingStats, Borrowing, Copy, ReturnedBook, Review, User, UserProfile,
+)
+
+# Synthetic datasets for reproducing performance problems locally. Seeded rows
+# are recognisable by their numbered keys, so purge() never touches real data:
+# seeded ISBNs start with a letter, which no real ISBN does.
+SEED_ISBN_PREFIX = 'S'
+SEED_USERNAME_PREFIX = 'seed_'
+SEED_PASSWORD = 'library'
+
+LOAN_DAYS = 14
+
+_ADJECTIVES = [
+    'Silent', 'Hidden', 'Broken', 'Golden', 'Last', 'Lost', 'Crimson', 'Distant', 'Endless', 'Frozen',
+    'Burning', 'Quiet', 'Secret', 'Wild', 'Shattered', 'Forgotten', 'Hollow', 'Midnight', 'Bright', 'Iron',
+]
+_NOUNS = [
+    'River', 'Kingdom', 'Garden', 'Empire', 'Archive', 'Harbor', 'Orchard', 'Machine', 'Winter', 'Library',
+    'Mountain', 'Signal', 'Lantern', 'Forest', 'Voyage', 'Theorem', 'Compass', 'Station', 'Island', 'Crown',
+]
+_PLACES = ['Avalon', 'the North', 'Tomorrow', 'the Deep', 'Dust', 'Glass', 'Ash', 'Stars', 'the City', 'Salt']
+_FIRST_NAMES = [
+    'Ada', 'Ben', 'Chloe', 'Daniel', 'Elena', 'Farid', 'Grace', 'Hiro', 'Isla', 'Jonas',
+    'Kofi', 'Lena', 'Mateo', 'Nadia', 'Omar', 'Priya', 'Quinn', 'Rosa', 'Sven', 'Tara',
+]
+_LAST_NAMES = [
+    'Abbott', 'Baker', 'Castillo', 'Dubois', 'Eriksen', 'Fischer', 'Gupta', 'Hughes', 'Ito', 'Jensen',
+    'Kowalski', 'Larsen', 'Moreau', 'Nakamura', 'Okafor', 'Petrov', 'Rossi', 'Silva', 'Tanaka', 'Weber',
+]
+_CATEGORIES = ['Novel', 'Thriller', 'Classic', 'Science', 'Fantasy', 'Poetry', 'Reference', 'Children', 'Essays']
+_GENRE_WEIGHTS = {
+    'FICTION': 30, 'NON_FICTION': 15, 'SCI_FI': 12, 'MYSTERY': 15, 'ROMANCE': 12, 'BIOGRAPHY': 8, 'HISTORY': 8,
+}
+# Readers rate the books they finish generously
+_RATING_WEIGHTS = [4, 8, 20, 38, 30]
+
+
+def zipf_weights(n, exponent):
+    """Cumulative Zipf weights for ranks 1..n, for random.choices(cum_weights=...)"""
+    return list(accumulate(1 / rank ** exponent for rank in range(1, n + 1)))
+
+
+def _batches(total, size):
+    for start in range(0, total, size):
+        yield start, min(size, total - start)
+
+
+@contextmanager
+def explicit_timestamps(*fields):
+    """Let bulk_create store the given auto_now(_add) values instead of the current time"""
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field, _, _ in saved:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Seeder:
+    """
+    Generates a library of the requested size from a seed.
+
+    The same seed and sizes produce the same rows on any backend; dates are
+    relative to the start of the anchor day, so runs on the same day match
+    exactly. Rows are written with bulk_create in batches, one transaction per
+    batch; only ids, per-book and per-reader counters and reviewed (reader,
+    book) pairs are kept in memory.
+    """
+
+    def __init__(self, seed=42, batch_size=5000, days=730, overdue_rate=0.08, review_rate=0.3,
+                 zipf_exponent=1.1, anchor=None, log=None):
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.days = days
+        self.overdue_rate = overdue_rate
+        self.review_rate = review_rate
+        self.zipf_exponent = zipf_exponent
+        anchor = anchor or timezone.localdate()
+        self.now = timezone.make_aware(datetime.combine(anchor, time()))
+        self.log = log or (lambda message: None)
+
+    def run(self, books, users, borrowings):
+        book_ids = self.create_books(books)
+        user_ids = self.create_users(users)
+        ratings = self.create_borrowings(book_ids, user_ids, borrowings)
+        self.create_copies(book_ids)
+        self.create_rating_stats(ratings)
+        return {
+            'books': len(book_ids),
+            'users': len(user_ids),
+            'borrowings': borrowings,
+            'reviews': sum(count for _, count in ratings.values()),
+        }
+
+    def _first_number(self, queryset, field, prefix):
+        """Seeded rows are numbered; continue after the highest existing number"""
+        last = queryset.order_by(f'-{field}').values_list(field, flat=True).first()
+        return int(last[len(prefix):]) + 1 if last else 1
+
+    def _title(self):
+        rng = self.rng
+        title = f"The {rng.choice(_ADJECTIVES)} {rng.choice(_NOUNS)}"
+        if rng.random() < 0.4:
+            title += f" of {rng.choice(_PLACES)}"
+        return title
+
+    def create_books(self, count):
+        rng = self.rng
+        genres, genre_weights = list(_GENRE_WEIGHTS), list(accumulate(_GENRE_WEIGHTS.values()))
+        first = self._first_number(seeded_books(), 'isbn', SEED_ISBN_PREFIX)
+        for start, size in _batches(count, self.batch_size):
+            books = []
+            for number in range(first + start, first + start + size):
+                year = max(1800, self.now.year - int(rng.expovariate(1 / 25)))
+                books.append(Book(
+                    title=self._title(),
+                    author=f"{rng.choice(_FIRST_NAMES)} {rng.choice(_LAST_NAMES)}",
+                    isbn=f'{SEED_ISBN_PREFIX}{number:012d}',
+                    description="Synthetic book generated by seed_library.",
+                    category=rng.choice(_CATEGORIES),
+                    published_date=date(year, rng.randint(1, 12), rng.randint(1, 28)),
+                    genre=rng.choices(genres, cum_weights=genre_weights)[0],
+                    available_copies=rng.choices([1, 2, 3, 4, 5], [40, 30, 15, 10, 5])[0],
+                ))
+            Book.objects.bulk_create(books)
+            self.log(f"Books: {start + size}/{count}")
+        # Not every backend returns primary keys from bulk_create, so look them up
+        return list(seeded_books().filter(isbn__gte=f'{SEED_ISBN_PREFIX}{first:012d}')
+                    .order_by('isbn').values_list('id', flat=True))
+
+    def create_users(self, count):
+        rng = self.rng
+        password = make_password(SEED_PASSWORD)  # Hashing is slow; every seeded user shares one hash
+        first = self._first_number(seeded_users(), 'username', SEED_USERNAME_PREFIX)
+        user_ids = []
+        for start, size in _batches(count, self.batch_size):
+            users = []
+            for number in range(first + start, first + start + size):
+                first_name, last_name = rng.choice(_FIRST_NAMES), rng.choice(_LAST_NAMES)
+                users.append(User(
+                    username=f'{SEED_USERNAME_PREFIX}{number:08d}',
+                    first_name=first_name,
+                    last_name=last_name,
+                    email=f'{first_name}.{last_name}.{number}@example.com'.lower(),
+                    password=password,
+                    date_joined=self.now - timedelta(days=self.days + rng.randint(0, 365)),
+                ))
+            with transaction.atomic():
+                User.objects.bulk_create(users)
+                ids = list(User.objects.filter(username__in=[u.username for u in users])
+                           .order_by('username').values_list('id', flat=True))
+                UserProfile.objects.bulk_create([UserProfile(user_id=user_id) for user_id in ids])
+            user_ids.extend(ids)
+            self.log(f"Users: {start + size}/{count}")
+        return user_ids
+
+    def create_borrowings(self, book_ids, user_ids, count):
+        """
+        Loans with Zipf-distributed book popularity and reader activity.
+
+        Loans due before the anchor are returned, some late, except for the
+        overdue_rate share that is still out; no reader has more than
+        MAX_ACTIVE_LOANS loans out, nor two of the same book, as checkout()
+        enforces. A review_rate share of returned
+        loans is reviewed once per reader and book. Returns (rating sum,
+        rating count) per reviewed book.
+        """
+        rng = self.rng
+        # Popularity follows rank, not id, so popular books are spread across the catalogue
+        books = list(book_ids)
+        rng.shuffle(books)
+        readers = list(user_ids)
+        rng.shuffle(readers)
+        book_weights = zipf_weights(len(books), self.zipf_exponent)
+        reader_weights = zipf_weights(len(readers), 0.8)
+        genres = dict(seeded_books().values_list('id', 'genre').iterator())
+        policies = load_policies()
+        span = self.days * 24 * 60
+        open_loans = {}  # Per reader, who never holds more than the loan limit
+        open_pairs = set()  # (reader, book) pairs on loan
+        ratings = {}
+        reviewed = set()
+        ratings_by_star = list(accumulate(_RATING_WEIGHTS))
+
+        fields = [Borrowing._meta.get_field('borrowed_date')]
+        fields += [Review._meta.get_field(name) for name in ('created_at', 'updated_at')]
+        with explicit_timestamps(*fields):
+            for start, size in _batches(count, self.batch_size):
+                loans = []
+                reviews = []
+                chosen_books = rng.choices(books, cum_weights=book_weights, k=size)
+                chosen_readers = rng.choices(readers, cum_weights=reader_weights, k=size)
+                for book_id, user_id in zip(chosen_books, chosen_readers):
+                    borrowed = self.now - timedelta(minutes=rng.randrange(span))
+                    due = borrowed + timedelta(days=LOAN_DAYS)
+                    loan = Borrowing(book_id=book_id, user_id=user_id, borrowed_date=borrowed, due_date=due)
+                    pair = (user_id, book_id)
+                    blocked = open_loans.get(user_id, 0) >= MAX_ACTIVE_LOANS or pair in open_pairs
+                    if not blocked and due > self.now:
+                        open_loans[user_id] = open_loans.get(user_id, 0) + 1  # Still out and not yet due
+                        open_pairs.add(pair)
+                    elif not blocked and rng.random() < self.overdue_rate:
+                        loan.status = 'OVERDUE'
+                        loan.late_fee = compute_fee(due, self.now, policy_for(genres[book_id], policies))
+                        open_loans[user_id] = open_loans.get(user_id, 0) + 1
+                        open_pairs.add(pair)
+                    else:
+                        # Most readers return on time; a tail returns up to three weeks late
+                        returned = borrowed + timedelta(days=min(rng.expovariate(1 / 9), LOAN_DAYS + 21))
+                        returned = min(returned, self.now)
+                        loan.status = 'RETURNED'
+                        loan.returned_date = returned
+                        # Historic fees count as paid, so no ledger entries are written
+                        loan.late_fee = compute_fee(due, returned, policy_for(genres[book_id], policies))
+                        if pair not in reviewed and rng.random() < self.review_rate:
+                            reviewed.add(pair)
+                            rating = bisect_left(ratings_by_star, rng.random() * ratings_by_star[-1]) + 1
+                            reviews.append(Review(
+                                book_id=book_id, user_id=user_id, rating=rating, counted_rating=rating,
+                                comment=rng.choice(["", "", "Enjoyed it.", "Hard to put down.", "Not for me."]),
+                                created_at=returned, updated_at=returned, moderated_at=returned,
+                            ))
+                            total, votes = ratings.get(book_id, (0, 0))
+                            ratings[book_id] = (total + rating, votes + 1)
+                    loans.append(loan)
+                with transaction.atomic():
+                    Borrowing.objects.bulk_create(loans)
+                    Review.objects.bulk_create(reviews)
+                self.log(f"Borrowings: {start + size}/{count}")
+        return ratings
+
+    def create_copies(self, book_ids):
+        """Barcoded copies: available_copies on the shelf plus one on loan per open loan"""
+        for start in range(0, len(book_ids), self.batch_size):
+            ids = book_ids[start:start + self.batch_size]
+            copies_from_counts(Book.objects.filter(id__in=ids).only('id', 'isbn', 'available_copies'))
+            self.log(f"Copies: {start + len(ids)}/{len(book_ids)} books")
+
+    def create_rating_stats(self, ratings):
+        BookRatingStats.objects.bulk_create(
+            [BookRatingStats(book_id=book_id, rating_sum=total, rating_count=votes)
+             for book_id, (total, votes) in ratings.items()],
+            batch_size=self.batch_size)
+
+
+def _numbered(field, prefix):
+    """Keys of prefix and a number, as a range the unique index on the key can serve"""
+    return {f'{field}__gte': f'{prefix}0', f'{field}__lt': f'{prefix}:'}
+
+
+def seeded_books():
+    return Book.objects.filter(**_numbered('isbn', SEED_ISBN_PREFIX))
+
+
+def seeded_users():
+    return User.objects.filter(**_numbered('username', SEED_USERNAME_PREFIX))
+
+
+def archive(stream, batch_size=5000):
+    """
+    Write every seeded row to stream as a JSON Lines fixture.
+
+    The file can be loaded back with loaddata; models are written in
+    dependency order and read with iterator(), so memory use stays flat.
+    """
+    books, users = seeded_books(), seeded_users()
+    querysets = [
+        books,
+        Copy.objects.filter(book__in=books),
+        users,
+        UserProfile.objects.filter(user__in=users),
+        Borrowing.objects.filter(book__in=books),
+        ArchivedBorrowing.objects.filter(book__in=books),
+        ReturnedBook.objects.filter(book__in=books),
+        Review.objects.filter(book__in=books),
+        BookRatingStats.objects.filter(book__in=books),
+    ]
+    for queryset in querysets:
+        serializers.serialize('jsonl', queryset.order_by('pk').iterator(chunk_size=batch_size), stream=stream)
+
+
+def purge(batch_size=5000, log=None):
+    """
+    Delete every seeded book and user with everything that refers to them.
+
+    Works in batches of ids, each in its own transaction. Seeded reviews
+    are uncounted first so deleting them does not queue rating deltas for
+    books that are about to disappear. Returns (books, users) deleted.
+    """
+    log = log or (lambda message: None)
+    deleted = {'books': 0, 'users': 0}
+    for name, queryset in (('books', seeded_books()), ('users', seeded_users())):
+        while True:
+            ids = list(queryset.order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            with transaction.atomic():
+                owner = 'book_id__in' if name == 'books' else 'user_id__in'
+                Review.objects.filter(**{owner: ids}).update(counted_rating=None)
+                queryset.model.objects.filter(id__in=ids).delete()
+            deleted[name] += len(ids)
+            log(f"Deleted {deleted[name]} {name}")
+    return deleted['books'], deleted['users']
+
+
+def vacuum():
+    """Return the space freed by a purge to the operating system"""
+    models = [Book, Copy, User, UserProfile, Borrowing, ArchivedBorrowing, ReturnedBook, Review, BookRatingStats]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('VACUUM')
+        elif connection.vendor == 'mysql':
+            tables = ', '.join(connection.ops.quote_name(model._meta.db_table) for model in models)
+            cursor.execute(f'OPTIMIZE TABLE {tables}')
+            cursor.fetchall()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -48,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'library.memo.request_memo_middleware',
 ]
 
 ROOT_URLCONF = 'mylms.urls'
@@ -85,6 +87,57 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/6.0/topics/cache/
+# 'default' holds the circulation and review rate-limit entries; each process
+# may keep its own, as every decision they feed is re-checked against the
+# database. 'auth' holds sessions and logged-in users, so it must be shared by
+# every worker: a logout, password change or deactivation drops the entry in
+# one place only. Set LIBRARY_REDIS_URL (e.g. redis://127.0.0.1:6379/1) to use
+# Redis for both, which is required once workers run on more than one host;
+# without it 'auth' is a file cache shared by the workers of this host.
+
+LIBRARY_REDIS_URL = os.environ.get('LIBRARY_REDIS_URL', '')
+
+if LIBRARY_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': LIBRARY_REDIS_URL,
+        },
+        'auth': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': LIBRARY_REDIS_URL,
+            'KEY_PREFIX': 'auth',
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'silent-library',
+        },
+        'auth': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': BASE_DIR / '.django_cache' / 'auth',
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        },
+    }
+
+# Sessions are read from the shared cache and only fall back to the database on a miss
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_CACHE_ALIAS = 'auth'
+
+
+# Authentication
+# request.user and its profile are served from the shared cache (see backends.py)
+
+AUTHENTICATION_BACKENDS = [
+    'library.backends.CachedModelBackend',
+]
+USER_CACHE_ALIAS = 'auth'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
@@ -127,6 +180,18 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Uploads are screened by library.uploads while the request is still streaming
+# and are always spooled to temporary files on disk, never held in memory
+FILE_UPLOAD_HANDLERS = [
+    'library.uploads.ImageUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+MAX_IMAGE_UPLOAD_SIZE = 5 * 1024 * 1024
+MAX_IMAGE_DIMENSION = 6000
+
+# Returned loans older than this move to the archive table (archive_borrowings)
+BORROWING_ARCHIVE_AFTER_DAYS = 180
+
 
 # Email Configuration (for development - prints to console)
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
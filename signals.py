@@ -0,0 +1,51 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import circulation, reviews, typeahead
+from .backends import invalidate_user
+from .models import Book, Borrowing, RatingDelta, Review, UserProfile
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=UserProfile)
+def invalidate_cached_user_profile(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=Book)
+def invalidate_book_availability(sender, instance, **kwargs):
+    circulation.invalidate(book_id=instance.pk)
+
+
+@receiver(post_save, sender=Book)
+def reindex_book(sender, instance, **kwargs):
+    transaction.on_commit(lambda: typeahead.index.update(instance.pk, instance.title, instance.author))
+
+
+@receiver(post_delete, sender=Book)
+def unindex_book(sender, instance, **kwargs):
+    book_id = instance.pk
+    transaction.on_commit(lambda: typeahead.index.update(book_id))
+
+
+@receiver(post_delete, sender=Borrowing)
+def invalidate_loan_state(sender, instance, **kwargs):
+    circulation.invalidate(user_id=instance.user_id, book_id=instance.book_id)
+
+
+@receiver(post_save, sender=Review)
+def account_review_rating(sender, instance, raw=False, **kwargs):
+    if not raw:
+        reviews.account([instance])
+
+
+@receiver(post_delete, sender=Review)
+def withdraw_review_rating(sender, instance, **kwargs):
+    if instance.counted_rating is not None:
+        RatingDelta.objects.create(book_id=instance.book_id, rating_sum=-instance.counted_rating, rating_count=-1)
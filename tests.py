@@ -1,5 +1,24 @@
-from django.test import TestCase, Client
-from .models import User, UserProfile
+from django.test import TestCase, Client, override_settings
+from django.urls import reverse
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from io import BytesIO, StringIO
+import base64
+import json
+from unittest import mock
+from .analytics import refresh_rollups
+from .backends import USER_CACHE_ALIAS, CachedModelBackend
+from .fees import accrue_open_fees, settle_return, user_balance
+from . import admin as library_admin, circulation, memo, reviews, typeahead
+from .models import User, UserProfile, Book, ArchivedBorrowing, BookRatingStats, Copy, RatingDelta, ReturnedBook, Review, Borrowing, RollupWatermark, BookRecommendation, DailyRollup, FeePolicy, FeeLedgerEntry, prefetch_book_stats
+from datetime import date, timedelta
+from PIL import Image
+from decimal import Decimal
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 class LibraryTest(TestCase):
 
@@ -23,4 +42,895 @@ class LibraryTest(TestCase):
 
     def test_sample(self):
         """This test will always pass just to prove the runner is working"""
-        self.assertEqual(1, 1)
\ No newline at end of file
+        self.assertEqual(1, 1)
+
+class AsyncViewTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader", password="lithan")
+        self.other = User.objects.create_user(username="other", password="lithan")
+        self.book = Book.objects.create(
+            title="Dune", author="Frank Herbert", isbn="9780441013593",
+            description="Desert planet", category="Novel",
+            published_date=date(1965, 8, 1), genre="SCI_FI",
+        )
+        Review.objects.create(book=self.book, user=self.user, rating=4)
+        Review.objects.create(book=self.book, user=self.other, rating=5)
+
+    def test_book_list_uses_annotated_ratings(self):
+        response = self.client.get(reverse('book_list'), {'search': 'dune'})
+        self.assertEqual(response.status_code, 200)
+        book = response.context['books'][0]
+        with self.assertNumQueries(0):
+            self.assertEqual(book.average_rating, 4.5)
+            self.assertEqual(book.rating_count, 2)
+
+    def test_book_reviews_rating_breakdown(self):
+        self.client.login(username="reader", password="lithan")
+        response = self.client.get(reverse('book_reviews', args=[self.book.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['average_rating'], 4.5)
+        self.assertEqual(response.context['rating_5_count'], 1)
+        self.assertEqual(response.context['rating_4_count'], 1)
+        self.assertTrue(response.context['user_has_reviewed'])
+
+    def test_borrow_book_decrements_copies(self):
+        self.client.login(username="reader", password="lithan")
+        response = self.client.post(reverse('borrow_book', args=[self.book.id]))
+        self.assertRedirects(response, reverse('my_borrowings'), fetch_redirect_response=False)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available_copies, 0)
+        self.assertTrue(Borrowing.objects.filter(book=self.book, user=self.user, status='BORROWED').exists())
+
+
+class CachedUserTest(TestCase):
+
+    def setUp(self):
+        caches[USER_CACHE_ALIAS].clear()
+        self.user = User.objects.create_user(username="reader", password="lithan")
+        self.profile = UserProfile.objects.create(user=self.user, bio="Old bio")
+        self.backend = CachedModelBackend()
+
+    def test_cached_user_includes_profile(self):
+        self.backend.get_user(self.user.pk)
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+            self.assertEqual(user.profile.bio, "Old bio")
+
+    def test_profile_save_invalidates_cached_user(self):
+        self.backend.get_user(self.user.pk)
+        self.profile.bio = "New bio"
+        self.profile.save()
+        self.assertEqual(self.backend.get_user(self.user.pk).profile.bio, "New bio")
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cached_db',
+                       AUTHENTICATION_BACKENDS=['library.backends.CachedModelBackend'])
+    def test_logged_in_page_skips_session_and_user_queries(self):
+        self.client.login(username="reader", password="lithan")
+        url = reverse('my_borrowings')
+        self.client.get(url)  # Caches the user
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        tables = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('django_session', tables)
+        self.assertNotIn('"auth_user"', tables)
+        # Overdue refresh, the history totals and the loan lists; nothing for the session or user
+        with self.assertNumQueries(7):
+            self.client.get(url)
+
+
+class RecommendationTest(TestCase):
+
+    def make_book(self, title, isbn):
+        return Book.objects.create(
+            title=title, author="Author", isbn=isbn, description="", category="Novel",
+            published_date=date(2000, 1, 1),
+        )
+
+    def test_build_recommendations_ranks_co_borrowed_books(self):
+        dune, messiah, emma = (self.make_book(t, i) for t, i in
+                               [("Dune", "1"), ("Dune Messiah", "2"), ("Emma", "3")])
+        due = timezone.now() + timedelta(days=14)
+        for name, books in [("a", [dune, messiah]), ("b", [dune, messiah]), ("c", [dune, emma])]:
+            user = User.objects.create_user(username=name, password="lithan")
+            for book in books:
+                Borrowing.objects.create(book=book, user=user, due_date=due)
+
+        call_command('build_recommendations', stdout=StringIO())
+
+        neighbours = list(BookRecommendation.objects.filter(book=dune)
+                          .values_list('recommended_book__title', flat=True))
+        self.assertEqual(neighbours, ["Dune Messiah", "Emma"])
+
+
+class AnalyticsRollupTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader", password="lithan")
+        self.book = Book.objects.create(
+            title="Dune", author="Frank Herbert", isbn="9780441013593", description="",
+            category="Novel", published_date=date(1965, 8, 1), genre="SCI_FI",
+        )
+
+    def test_refresh_only_counts_new_activity(self):
+        Borrowing.objects.create(book=self.book, user=self.user, due_date=timezone.now() + timedelta(days=14))
+        refresh_rollups(until=timezone.now())
+        Borrowing.objects.create(book=self.book, user=self.user, due_date=timezone.now() + timedelta(days=14))
+        Review.objects.create(book=self.book, user=self.user, rating=4)
+        refresh_rollups(until=timezone.now())
+
+        rollup = DailyRollup.objects.get(genre="SCI_FI", category="Novel")
+        self.assertEqual(rollup.borrows, 2)
+        self.assertEqual(rollup.rating_count, 1)
+        self.assertEqual(rollup.average_rating, 4)
+
+    def test_only_approved_reviews_are_rolled_up(self):
+        other = User.objects.create_user(username="other", password="lithan")
+        spam = Review(book=self.book, user=self.user, rating=1, comment="Cheap pills at http://spam.example")
+        reviews.queue_for_moderation(spam)
+        pending = Review(book=self.book, user=other, rating=5, comment="Loved it")
+        reviews.queue_for_moderation(pending)
+        refresh_rollups(until=timezone.now())
+        self.assertFalse(DailyRollup.objects.filter(rating_count__gt=0).exists())
+
+        reviews.moderate([spam], 'REJECTED')
+        reviews.moderate([pending], 'APPROVED')
+        refresh_rollups(until=timezone.now())
+        rollup = DailyRollup.objects.get(genre="SCI_FI", category="Novel")
+        self.assertEqual((rollup.rating_count, rollup.rating_sum), (1, 5))
+
+    def test_review_approved_again_after_an_edit_counts_once(self):
+        review = Review(book=self.book, user=self.user, rating=2, comment="Slow start")
+        reviews.queue_for_moderation(review)
+        reviews.moderate([review], 'APPROVED')
+        refresh_rollups(until=timezone.now())
+        review.rating, review.comment = 4, "Slow start, great ending"
+        reviews.queue_for_moderation(review)
+        reviews.moderate([review], 'APPROVED')
+        refresh_rollups(until=timezone.now())
+        rollup = DailyRollup.objects.get(genre="SCI_FI", category="Novel")
+        self.assertEqual((rollup.rating_count, rollup.rating_sum), (1, 4))
+
+    def test_analytics_page_reads_rollups(self):
+        admin = User.objects.create_superuser(username="admin", password="lithan")
+        self.client.force_login(admin)
+        Borrowing.objects.create(book=self.book, user=self.user, due_date=timezone.now() + timedelta(days=14))
+        refresh_rollups(until=timezone.now())
+        response = self.client.get(reverse('library_analytics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['totals']['borrows'], 1)
+
+
+class UserDashboardTest(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username="admin", password="lithan")
+        self.client.force_login(self.admin)
+        book = Book.objects.create(
+            title="Dune", author="Frank Herbert", isbn="9780441013593", description="",
+            category="Novel", published_date=date(1965, 8, 1),
+        )
+        for i in range(5):
+            user = User.objects.create_user(username=f"patron{i}", password="lithan")
+            for _ in range(i):
+                Borrowing.objects.create(book=book, user=user, due_date=timezone.now() + timedelta(days=14))
+
+    def test_stats_and_annotations(self):
+        response = self.client.get(reverse('user_dashboard'), {'sort': 'active'})
+        self.assertEqual(response.context['stats'], {'total': 6, 'staff': 1, 'active': 6})
+        users = response.context['users']
+        self.assertEqual([u.active_borrowings for u in users], [4, 3, 2, 1, 0, 0])
+
+    def test_fees_column_is_the_ledger_balance(self):
+        patron = User.objects.get(username="patron2")
+        Borrowing.objects.filter(user=patron).update(late_fee=Decimal('1.25'))
+        FeeLedgerEntry.objects.create(user=patron, entry_type='CHARGE', amount=Decimal('5.00'))
+        FeeLedgerEntry.objects.create(user=patron, entry_type='PAYMENT', amount=Decimal('2.00'))
+        FeeLedgerEntry.objects.create(user=patron, entry_type='WAIVER', amount=Decimal('1.00'))
+        response = self.client.get(reverse('user_dashboard'), {'sort': 'fees'})
+        top = response.context['users'][0]
+        self.assertEqual(top, patron)
+        self.assertEqual(top.outstanding_fees, user_balance(patron))
+        self.assertEqual(top.accrued_fees, Decimal('2.50'))
+
+    def test_keyset_pagination_visits_every_user_once(self):
+        seen, params = [], {'sort': 'active'}
+        with mock.patch('library.views.USERS_PER_PAGE', 2):
+            while True:
+                response = self.client.get(reverse('user_dashboard'), params)
+                seen += [u.username for u in response.context['users']]
+                if not response.context['next_cursor']:
+                    break
+                params['after'] = response.context['next_cursor']
+        self.assertEqual(sorted(seen), sorted(User.objects.values_list('username', flat=True)))
+        self.assertEqual(len(seen), 6)
+
+
+    def test_malformed_cursor_falls_back_to_first_page(self):
+        for sort, value in [('newest', "not a date"), ('active', "many"), ('fees', "NaN"), ('username', 7)]:
+            cursor = base64.urlsafe_b64encode(json.dumps([value, 1]).encode()).decode()
+            response = self.client.get(reverse('user_dashboard'), {'sort': sort, 'after': cursor})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.context['is_first_page'])
+        response = self.client.get(reverse('user_dashboard'), {'after': "%%%"})
+        self.assertEqual(len(response.context['users']), 6)
+
+
+class LateFeeTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader", password="lithan")
+        self.novel = Book.objects.create(
+            title="Emma", author="Jane Austen", isbn="1", description="", category="Novel",
+            published_date=date(1815, 12, 23), genre="ROMANCE",
+        )
+        self.history = Book.objects.create(
+            title="SPQR", author="Mary Beard", isbn="2", description="", category="Ancient",
+            published_date=date(2015, 10, 20), genre="HISTORY",
+        )
+        FeePolicy.objects.create(genre="HISTORY", daily_rate=Decimal('1.00'), grace_days=2, max_fee=Decimal('5.00'))
+
+    def borrow(self, book, days_overdue):
+        borrowing = Borrowing.objects.create(book=book, user=self.user, due_date=timezone.now() + timedelta(days=14))
+        Borrowing.objects.filter(pk=borrowing.pk).update(
+            due_date=timezone.now() - timedelta(days=days_overdue, hours=1))
+        borrowing.refresh_from_db()
+        return borrowing
+
+    def test_accrual_applies_genre_policy(self):
+        default = self.borrow(self.novel, 4)
+        capped = self.borrow(self.history, 20)
+        graced = self.borrow(self.history, 1)
+
+        updated, flagged = accrue_open_fees()
+
+        self.assertEqual((updated, flagged), (2, 3))
+        for borrowing, fee in [(default, '2.00'), (capped, '5.00'), (graced, '0.00')]:
+            borrowing.refresh_from_db()
+            self.assertEqual(borrowing.late_fee, Decimal(fee))
+            self.assertEqual(borrowing.status, 'OVERDUE')
+
+    def test_return_posts_charge_to_ledger(self):
+        borrowing = self.borrow(self.novel, 3)
+        borrowing.status = 'RETURNED'
+        settle_return(borrowing)
+        borrowing.save()
+        FeeLedgerEntry.objects.create(user=self.user, entry_type='PAYMENT', amount=Decimal('1.00'))
+        self.assertEqual(borrowing.late_fee, Decimal('1.50'))
+        self.assertEqual(user_balance(self.user), Decimal('0.50'))
+
+
+class CirculationCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="reader", password="lithan")
+        self.book = Book.objects.create(
+            title="Dune", author="Frank Herbert", isbn="9780441013593", description="",
+            category="Novel", published_date=date(1965, 8, 1), available_copies=2,
+        )
+        self.client.force_login(self.user)
+
+    def test_borrow_and_return_write_through(self):
+        self.assertEqual(circulation.get_availability(self.book.id), 2)
+        self.assertEqual(circulation.get_loan_state(self.user.id), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('borrow_book', args=[self.book.id]))
+        with self.assertNumQueries(0):
+            self.assertEqual(circulation.get_availability(self.book.id), 1)
+            self.assertEqual(circulation.get_loan_state(self.user.id), [self.book.id])
+
+        borrowing = Borrowing.objects.get(user=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('return_book', args=[borrowing.id]))
+        with self.assertNumQueries(0):
+            self.assertEqual(circulation.get_availability(self.book.id), 2)
+            self.assertEqual(circulation.get_loan_state(self.user.id), [])
+
+    def test_consistency_check_reports_drift(self):
+        circulation.get_availability(self.book.id)
+        Book.objects.filter(id=self.book.id).update(available_copies=7)
+        out = StringIO()
+        call_command('check_circulation_cache', '--fix', stdout=out)
+        self.assertIn("1 drifted cache entries dropped", out.getvalue())
+        self.assertEqual(circulation.get_availability(self.book.id), 7)
+
+    def test_stale_refusal_in_cache_does_not_block_borrowing(self):
+        Book.objects.filter(id=self.book.id).update(available_copies=0)
+        self.assertEqual(circulation.get_availability(self.book.id), 0)
+        # A return handled by another worker, which never touched this cache
+        Book.objects.filter(id=self.book.id).update(available_copies=1)
+
+        response = self.client.get(reverse('borrow_book', args=[self.book.id]))
+        self.assertTemplateUsed(response, 'confirm_borrow.html')
+        cache.set(circulation.availability_key(self.book.id), 0)
+        response = self.client.post(reverse('borrow_book', args=[self.book.id]))
+        self.assertRedirects(response, reverse('my_borrowings'), fetch_redirect_response=False)
+        self.assertTrue(Borrowing.objects.filter(book=self.book, user=self.user).exists())
+
+    def test_stale_loan_state_does_not_bypass_rules(self):
+        self.assertEqual(circulation.get_loan_state(self.user.id), [])
+        # Loans made by another worker, which never touched this cache
+        other_books = [
+            Book.objects.create(title=f"Book {i}", author="Author", isbn=f"97800000000{i:02d}", description="",
+                                category="Novel", published_date=date(2000, 1, 1))
+            for i in range(4)
+        ]
+        due = timezone.now() + timedelta(days=14)
+        for book in other_books + [self.book]:
+            Borrowing.objects.create(book=book, user=self.user, due_date=due)
+        self.assertEqual(circulation.get_loan_state(self.user.id), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('borrow_book', args=[self.book.id]))
+        self.assertRedirects(response, reverse('book_list'), fetch_redirect_response=False)
+        Borrowing.objects.filter(book__in=other_books[:2]).update(status='RETURNED', returned_date=timezone.now())
+        circulation.invalidate(user_id=self.user.id)
+        circulation.get_loan_state(self.user.id)
+        Borrowing.objects.create(book=other_books[0], user=self.user, due_date=due)
+        Borrowing.objects.create(book=other_books[1], user=self.user, due_date=due)
+        other = Book.objects.create(title="Emma", author="Jane Austen", isbn="9780141439587", description="",
+                                    category="Novel", published_date=date(1815, 12, 23))
+        response = self.client.post(reverse('borrow_book', args=[other.id]))
+        self.assertRedirects(response, reverse('my_borrowings'), fetch_redirect_response=False)
+        self.assertEqual(circulation.open_loans().filter(user=self.user).count(), 5)
+
+
+class RequestMemoTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader", password="lithan")
+        self.books = [
+            Book.objects.create(title=f"Book {i}", author="Author", isbn=str(i), description="",
+                                category="Novel", published_date=date(2000, 1, 1))
+            for i in range(3)
+        ]
+        Review.objects.create(book=self.books[0], user=self.user, rating=3)
+        self.token = memo._request_now.set(timezone.now())
+
+    def tearDown(self):
+        memo._request_now.reset(self.token)
+
+    def test_book_properties_query_once_per_request(self):
+        book = Book.objects.get(pk=self.books[0].pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(book.average_rating, 3)
+            self.assertEqual(book.rating_count, 1)
+            self.assertEqual(book.average_rating, 3)
+
+    def test_prefetch_book_stats_batches_queries(self):
+        with self.assertNumQueries(3):
+            books = prefetch_book_stats(Book.objects.all())
+        with self.assertNumQueries(0):
+            self.assertEqual([b.rating_count for b in books], [1, 0, 0])
+            self.assertEqual([b.total_borrowed for b in books], [0, 0, 0])
+
+    def test_borrowing_properties_use_request_snapshot(self):
+        borrowing = Borrowing.objects.create(
+            book=self.books[0], user=self.user, due_date=timezone.now() + timedelta(days=3, hours=1))
+        with mock.patch('django.utils.timezone.now') as now:
+            self.assertFalse(borrowing.is_overdue())
+            self.assertEqual(borrowing.days_left, 3)
+            self.assertEqual(borrowing.overdue_days, 0)
+            now.assert_not_called()
+
+
+class BulkBorrowingTest(TestCase):
+
+    def setUp(self):
+        self.staff = User.objects.create_user(username="staff", password="lithan", is_staff=True)
+        self.client.force_login(self.staff)
+        self.reader = User.objects.create_user(username="reader", password="lithan")
+        self.book = Book.objects.create(
+            title="Dune", author="Frank Herbert", isbn="9780441013593", description="",
+            category="Novel", published_date=date(1965, 8, 1), available_copies=0,
+        )
+        due = timezone.now() + timedelta(days=14)
+        self.loans = [Borrowing.objects.create(book=self.book, user=self.reader, due_date=due) for _ in range(3)]
+
+    def test_bulk_return_by_id_and_isbn(self):
+        response = self.client.post(reverse('bulk_update_borrowings'), {
+            'status': 'RETURNED',
+            'borrowing_ids': [self.loans[0].id],
+            'isbn_list': "9780441013593\n9780441013593\n9780441013593\n0000000000",
+        })
+        results = [entry['result'] for entry in response.context['report']]
+        self.assertEqual(results, [
+            "Updated to returned", "Updated to returned", "Updated to returned",
+            "No open loan for this ISBN", "No open loan for this ISBN",
+        ])
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available_copies, 3)
+        self.assertFalse(Borrowing.objects.exclude(status='RETURNED').exists())
+
+
+class CopyCirculationTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.staff = User.objects.create_user(username="staff", password="lithan", is_staff=True)
+        self.reader = User.objects.create_user(username="reader", password="lithan")
+        self.book = Book.objects.create(
+            title="Dune", author="Frank Herbert", isbn="9780441013593", description="",
+            category="Novel", published_date=date(1965, 8, 1), available_copies=2,
+        )
+
+    def test_create_copies_converts_counts_and_open_loans(self):
+        loan = Borrowing.objects.create(book=self.book, user=self.reader, due_date=timezone.now() + timedelta(days=7))
+        out = StringIO()
+        call_command('create_copies', stdout=out)
+        self.assertIn("Created 3 copies for 1 books", out.getvalue())
+        loan.refresh_from_db()
+        self.assertEqual(loan.copy.barcode, "9780441013593-001")
+        self.assertEqual(loan.copy.status, 'ON_LOAN')
+        self.assertEqual(self.book.copies.filter(status='AVAILABLE').count(), 2)
+
+    def test_scan_checkout_and_checkin(self):
+        circulation.add_copies(self.book, 2)
+        self.client.force_login(self.staff)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('circulation_desk'), {
+                'mode': 'checkout', 'patron': 'reader', 'barcode': '9780441013593-002'})
+        self.assertEqual(response.context['result'], "Checked out to reader")
+        self.assertEqual(circulation.get_availability(self.book.id), 1)
+        self.assertEqual(circulation.get_loan_state(self.reader.id), [self.book.id])
+
+        response = self.client.post(reverse('circulation_desk'), {
+            'mode': 'checkout', 'patron': 'reader', 'barcode': '9780441013593-002'})
+        self.assertEqual(response.context['result'], "Copy is on loan")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('circulation_desk'), {'mode': 'checkin', 'barcode': '9780441013593-002'})
+        self.assertEqual(response.context['result'], "Returned by reader")
+        self.assertEqual(Copy.objects.get(barcode='9780441013593-002').status, 'AVAILABLE')
+        self.assertEqual(circulation.get_availability(self.book.id), 2)
+
+    def test_availability_is_recounted_from_copies(self):
+        circulation.add_copies(self.book, 2)
+        Book.objects.filter(id=self.book.id).update(available_copies=9)  # Drifted count
+        borrowing, refusal = circulation.checkout(self.book, self.reader, timezone.now() + timedelta(days=14))
+        self.assertIsNone(refusal)
+        self.assertEqual(borrowing.copy.status, 'ON_LOAN')
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available_copies, 1)
+
+    def test_tracked_availability_cannot_be_typed(self):
+        circulation.add_copies(self.book, 1)
+        circulation.sync_availability([self.book.id])
+        self.client.force_login(User.objects.create_superuser(username="admin", password="lithan"))
+        response = self.client.post(reverse('book_update', args=[self.book.id]), {
+            'title': "Dune", 'author': "Frank Herbert", 'isbn': "9780441013593", 'description': "Spice",
+            'category': "Novel", 'published_date': "1965-08-01", 'genre': 'SCI_FI',
+            'available_copies': 4, 'new_copies': 2,
+        })
+        self.assertRedirects(response, reverse('book_list'), fetch_redirect_response=False)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available_copies, 3)
+        self.assertEqual(self.book.copies.count(), 3)
+
+        self.client.post(reverse('admin:library_book_changelist'), {
+            'action': 'add_copy', '_selected_action': [self.book.id]})
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available_copies, 4)
+        response = self.client.get(reverse('admin:library_book_change', args=[self.book.id]))
+        self.assertNotContains(response, 'name="available_copies"')
+
+    def test_saving_a_book_keeps_the_recounted_availability(self):
+        circulation.add_copies(self.book, 2)
+        self.client.force_login(User.objects.create_superuser(username="admin", password="lithan"))
+        form_data = {
+            'title': "Dune", 'author': "Frank Herbert", 'isbn': "9780441013593", 'description': "Spice",
+            'category': "Novel", 'published_date': "1965-08-01", 'genre': 'SCI_FI',
+        }
+        circulation.checkout(self.book, self.reader, timezone.now() + timedelta(days=14))
+        # The count the form was loaded with, before the loan went out
+        Book.objects.filter(id=self.book.id).update(available_copies=2)
+        self.client.post(reverse('book_update', args=[self.book.id]), form_data)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available_copies, 1)
+
+    def test_barcodes_continue_after_the_highest_number(self):
+        copies = circulation.add_copies(self.book, 3)
+        Copy.objects.filter(barcode=copies[0].barcode).delete()
+        circulation.add_copies(self.book, 1)
+        self.assertEqual(sorted(self.book.copies.values_list('barcode', flat=True)),
+                         ["9780441013593-002", "9780441013593-003", "9780441013593-004"])
+
+    def test_scan_lookup_query_count(self):
+        circulation.add_copies(self.book, 2)
+        # Copy lookup, patron's loans (cached after the first scan), patron row
+        # lock and loans re-read, copy flip, recount and loan insert, plus the savepoint
+        with self.assertNumQueries(9):
+            circulation.checkout_copy('9780441013593-001', self.reader, timezone.now() + timedelta(days=14))
+
+
+def image_upload(name="cover.png", size=(8, 8), image_format='PNG'):
+    data = BytesIO()
+    Image.new('RGB', size).save(data, image_format)
+    return SimpleUploadedFile(name, data.getvalue(), content_type='image/png')
+
+
+class UploadValidationTest(TestCase):
+
+    def setUp(self):
+        self.book_data = {
+            'title': "Dune", 'author': "Frank Herbert", 'isbn': "9780441013593", 'description': "Spice",
+            'category': "Novel", 'published_date': "1965-08-01", 'available_copies': 1, 'genre': 'SCI_FI',
+        }
+        self.registration = {
+            'username': "reader", 'first_name': "Paul", 'last_name': "Atreides", 'email': "paul@example.com",
+            'password': "lithan123", 'password_confirm': "lithan123", 'terms': "on",
+        }
+
+    def test_valid_cover_is_saved(self):
+        response = self.client.post(reverse('book_create'), {**self.book_data, 'cover_pic': image_upload()})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(Book.objects.get().cover_pic.name.startswith('cover_pics/'))
+        Book.objects.get().cover_pic.delete()
+
+    def test_non_image_is_refused_while_streaming(self):
+        fake = SimpleUploadedFile("cover.png", b"MZ\x90\x00not really a png", content_type='image/png')
+        response = self.client.post(reverse('book_create'), {**self.book_data, 'cover_pic': fake})
+        self.assertIn("Upload a JPEG, PNG, GIF or WebP image.", response.context['form'].errors['cover_pic'])
+        self.assertFalse(Book.objects.exists())
+
+    def test_oversize_upload_is_cut_off(self):
+        with mock.patch('library.uploads.MAX_IMAGE_UPLOAD_SIZE', 64):
+            response = self.client.post(reverse('register'), {
+                **self.registration, 'profile_picture': image_upload(size=(64, 64))})
+        self.assertContains(response, "Image is too large")
+        self.assertFalse(User.objects.exists())
+
+    def test_dimensions_are_read_from_the_header(self):
+        with mock.patch('library.uploads.MAX_IMAGE_DIMENSION', 16):
+            response = self.client.post(reverse('book_create'), {
+                **self.book_data, 'cover_pic': image_upload(size=(32, 8))})
+        self.assertIn("Image is 32x8 pixels; the maximum is 16 pixels per side.",
+                      response.context['form'].errors['cover_pic'])
+
+
+class TypeaheadTest(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(typeahead, 'index', typeahead.PrefixIndex())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dune = Book.objects.create(
+            title="Dune", author="Frank Herbert", isbn="9780441013593", description="",
+            category="Novel", published_date=date(1965, 8, 1))
+        Book.objects.create(title="Les Misérables", author="Victor Hugo", isbn="9780451419439", description="",
+                            category="Novel", published_date=date(1862, 1, 1))
+
+    def suggest(self, query):
+        response = self.client.get(reverse('book_typeahead'), {'q': query})
+        return [result['title'] for result in response.json()['results']]
+
+    def test_title_and_author_word_prefixes(self):
+        self.assertEqual(self.suggest("du"), ["Dune"])
+        self.assertEqual(self.suggest("HERB"), ["Dune"])
+        self.assertEqual(self.suggest("miser"), ["Les Misérables"])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest("x"), [])
+
+    def test_book_changes_update_the_index_in_place(self):
+        self.suggest("du")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dune.title = "Children of Dune"
+            self.dune.save()
+            Book.objects.create(title="Dracula", author="Bram Stoker", isbn="9780486411095", description="",
+                                category="Novel", published_date=date(1897, 5, 26))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest("d"), ["Dracula", "Children of Dune"])
+            self.assertEqual(self.suggest("chil"), ["Children of Dune"])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dune.delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest("d"), ["Dracula"])
+
+    def test_change_in_another_process_triggers_rebuild(self):
+        self.suggest("du")
+        # Saved by another process: the signals never ran here
+        Book.objects.filter(id=self.dune.id).update(title="Dune Messiah", updated_at=timezone.now())
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest("mess"), [])  # Not checked again until the interval is over
+        with mock.patch.object(typeahead, 'CHECK_INTERVAL', 0):
+            # Fingerprint check, then the rebuild's fingerprint and book list
+            with self.assertNumQueries(3):
+                self.assertEqual(self.suggest("mess"), ["Dune Messiah"])
+
+
+class FacetedCatalogTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader", password="lithan")
+        books = [
+            ("Dune", 'SCI_FI', "Novel", date(1965, 8, 1), 2),
+            ("Neuromancer", 'SCI_FI', "Novel", date(1984, 7, 1), 0),
+            ("Gone Girl", 'MYSTERY', "Thriller", date(2012, 6, 5), 1),
+            ("Emma", 'ROMANCE', "Novel", date(1815, 12, 23), 1),
+        ]
+        self.books = {}
+        for i, (title, genre, category, published, copies) in enumerate(books):
+            self.books[title] = Book.objects.create(
+                title=title, author="Author", isbn=str(i), description="", genre=genre, category=category,
+                published_date=published, available_copies=copies)
+        Review.objects.create(book=self.books["Dune"], user=self.user, rating=5)
+        Review.objects.create(book=self.books["Neuromancer"], user=self.user, rating=3)
+
+    def browse(self, query):
+        response = self.client.get(reverse('book_list') + query)
+        titles = sorted(book.title for book in response.context['books'])
+        counts = {facet['name']: {str(o['value']): o['count'] for o in facet['options']}
+                  for facet in response.context['facets']}
+        return titles, counts
+
+    def test_home_page_genre_links_filter(self):
+        titles, _ = self.browse("?genre=sci-fi")
+        self.assertEqual(titles, ["Dune", "Neuromancer"])
+
+    def test_combined_filters_and_counts_exclude_own_facet(self):
+        titles, counts = self.browse("?genre=SCI_FI&genre=ROMANCE&category=novel&available=1")
+        self.assertEqual(titles, ["Dune", "Emma"])
+        # Genre counts ignore the genre selection but respect the other facets
+        self.assertEqual(counts['genre'], {'SCI_FI': 1, 'ROMANCE': 1})
+        self.assertEqual(counts['available'], {'True': 2})
+        self.assertEqual(counts['category'], {'Novel': 2})
+        self.assertEqual(counts['decade'], {'1960': 1, '1810': 1})
+
+    def test_rating_threshold(self):
+        titles, counts = self.browse("?rating=4")
+        self.assertEqual(titles, ["Dune"])
+        self.assertEqual(counts['rating'], {'4': 1, '3': 2, '2': 2, '1': 2})
+
+    def test_filter_count_does_not_add_queries(self):
+        # Facet rows, books, recommendations, ratings and borrow counts
+        with self.assertNumQueries(5):
+            self.client.get(reverse('book_list'))
+        with self.assertNumQueries(5):
+            self.client.get(reverse('book_list') + "?genre=SCI_FI&category=Novel&decade=1960&available=1&rating=2")
+
+
+class ReviewPipelineTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.reader = User.objects.create_user(username="reader", password="lithan")
+        self.reader.date_joined = timezone.now() - timedelta(days=30)
+        self.reader.save()
+        self.other = User.objects.create_user(username="other", password="lithan")
+        self.book = Book.objects.create(
+            title="Dune", author="Frank Herbert", isbn="9780441013593", description="",
+            category="Novel", published_date=date(1965, 8, 1),
+        )
+        Borrowing.objects.create(book=self.book, user=self.reader, due_date=timezone.now(), status='RETURNED')
+        Review.objects.create(book=self.book, user=self.other, rating=2)
+        self.client.force_login(self.reader)
+
+    def submit(self, rating=5, comment="Loved the desert politics."):
+        return self.client.post(reverse('submit_review', args=[self.book.id]), {'rating': rating, 'comment': comment})
+
+    def test_submitted_review_waits_for_moderation(self):
+        self.submit()
+        review = Review.objects.get(user=self.reader)
+        self.assertEqual((review.status, review.flags, review.counted_rating), ('PENDING', '', None))
+        self.assertEqual(Book.objects.get(id=self.book.id).rating_count, 1)
+        # Visible to its author only, and not in the breakdown
+        response = self.client.get(reverse('book_reviews', args=[self.book.id]))
+        self.assertEqual(len(response.context['reviews']), 2)
+        self.assertEqual((response.context['review_count'], response.context['average_rating']), (1, 2.0))
+        self.client.force_login(self.other)
+        response = self.client.get(reverse('book_reviews', args=[self.book.id]))
+        self.assertEqual(len(response.context['reviews']), 1)
+
+        call_command('process_reviews', stdout=StringIO())
+        review.refresh_from_db()
+        self.assertEqual((review.status, review.counted_rating), ('APPROVED', 5))
+        book = Book.objects.get(id=self.book.id)
+        self.assertEqual((book.average_rating, book.rating_count), (3.5, 2))
+
+    def test_spam_flags_hold_review(self):
+        self.submit(comment="GREAT BOOK BUY CHEAP COPIES AT WWW.CHEAP-BOOKS.XYZ!!!!!!!")
+        review = Review.objects.get(user=self.reader)
+        self.assertEqual(review.flags, 'link, shouting, repeated characters')
+        self.assertEqual(reviews.approve_clean(), 0)
+        response = self.client.post(reverse('review_moderation'), {'action': 'APPROVED', 'review_ids': [review.id]})
+        self.assertEqual(response.status_code, 302)  # Staff only
+        self.reader.is_staff = True
+        self.reader.save()
+        self.client.post(reverse('review_moderation'), {'action': 'REJECTED', 'review_ids': [review.id]})
+        review.refresh_from_db()
+        self.assertEqual((review.status, review.counted_rating), ('REJECTED', None))
+
+    def test_new_account_extreme_rating_is_flagged(self):
+        review = Review(book=self.book, user=self.other, rating=1)
+        self.assertEqual(reviews.spam_flags(review), ['new account'])
+
+    def test_rate_limit(self):
+        with mock.patch.object(reviews, 'REVIEW_RATE_LIMIT', 2):
+            self.submit()
+            self.submit(rating=4)
+            response = self.submit(rating=1)
+        self.assertRedirects(response, reverse('book_reviews', args=[self.book.id]), fetch_redirect_response=False)
+        self.assertEqual(Review.objects.get(user=self.reader).rating, 4)
+
+    def test_deltas_fold_into_stats(self):
+        review = Review.objects.create(book=self.book, user=self.reader, rating=4)
+        review.rating = 5
+        review.save()
+        Review.objects.get(user=self.other).delete()
+        self.assertEqual(RatingDelta.objects.count(), 4)
+        self.assertEqual(Book.objects.get(id=self.book.id).rating_count, 1)
+
+        self.assertEqual(reviews.fold_rating_deltas(until=timezone.now()), 1)
+        self.assertFalse(RatingDelta.objects.exists())
+        stats = BookRatingStats.objects.get(book=self.book)
+        self.assertEqual((stats.rating_sum, stats.rating_count), (5, 1))
+        self.assertEqual(reviews.rebuild_rating_stats(), 1)
+        stats = BookRatingStats.objects.get(book=self.book)
+        self.assertEqual((stats.rating_sum, stats.rating_count), (5, 1))
+
+
+class SeedLibraryTest(TestCase):
+
+    def seed(self, *args):
+        call_command('seed_library', '--books', '30', '--users', '20', '--borrowings', '400', *args, stdout=StringIO())
+        return list(Borrowing.objects.order_by('id').values_list(
+            'book__isbn', 'user__username', 'borrowed_date', 'status', 'late_fee'))
+
+    def test_seed_is_deterministic_and_purge_keeps_real_data(self):
+        real = Book.objects.create(title="Dune", author="Frank Herbert", isbn="9780441013593", description="",
+                                   category="Novel", published_date=date(1965, 8, 1))
+        reader = User.objects.create_user('seed_fan', password='x')
+        first = self.seed()
+        self.assertEqual((Book.objects.count(), User.objects.count(), len(first)), (31, 21, 400))
+        self.assertEqual(UserProfile.objects.count(), 20)
+        # Every open loan has a copy on loan, no reader is over the loan limit or has a book twice
+        open_loans = Borrowing.objects.exclude(status='RETURNED')
+        self.assertEqual(Copy.objects.filter(status='ON_LOAN').count(), open_loans.count())
+        self.assertLessEqual(max(open_loans.values('user').annotate(n=Count('id')).values_list('n', flat=True)),
+                             circulation.MAX_ACTIVE_LOANS)
+        self.assertFalse(open_loans.values('user', 'book').annotate(n=Count('id')).filter(n__gt=1).exists())
+        reviewed = Review.objects.first().book
+        self.assertEqual(reviewed.rating_count, reviewed.reviews.count())
+
+        call_command('purge_library', stdout=StringIO())
+        self.assertEqual(list(Book.objects.all()), [real])
+        self.assertEqual(list(User.objects.all()), [reader])
+        self.assertFalse(Borrowing.objects.exists() or Review.objects.exists())
+        self.assertEqual(self.seed(), first)
+
+
+class BorrowingArchiveTest(TestCase):
+
+    def setUp(self):
+        self.reader = User.objects.create_user(username="reader", password="lithan")
+        UserProfile.objects.create(user=self.reader)
+        self.book = Book.objects.create(
+            title="Dune", author="Frank Herbert", isbn="9780441013593", description="",
+            category="Novel", published_date=date(1965, 8, 1),
+        )
+        now = timezone.now()
+        self.old = [
+            Borrowing.objects.create(book=self.book, user=self.reader, due_date=now - timedelta(days=days + 14),
+                                     returned_date=now - timedelta(days=days), status='RETURNED',
+                                     late_fee=Decimal('1.50'))
+            for days in (400, 300)
+        ]
+        self.charge = FeeLedgerEntry.objects.create(user=self.reader, borrowing=self.old[0], entry_type='CHARGE',
+                                                    amount=Decimal('1.50'))
+        self.recent = Borrowing.objects.create(book=self.book, user=self.reader, due_date=now - timedelta(days=5),
+                                               returned_date=now - timedelta(days=3), status='RETURNED')
+        self.open = Borrowing.objects.create(book=self.book, user=self.reader, due_date=now + timedelta(days=7))
+        self.client.force_login(self.reader)
+        refresh_rollups(until=now)
+
+    def test_nothing_is_archived_before_the_first_rollup(self):
+        RollupWatermark.objects.all().delete()
+        out = StringIO()
+        call_command('archive_borrowings', stdout=out)
+        self.assertIn("Nothing archived", out.getvalue())
+        self.assertFalse(ArchivedBorrowing.objects.exists())
+
+    def test_archive_moves_old_returns_and_keeps_history(self):
+        call_command('archive_borrowings', stdout=StringIO())
+        self.assertEqual(set(Borrowing.objects.values_list('id', flat=True)), {self.recent.id, self.open.id})
+        self.assertEqual(set(ArchivedBorrowing.objects.values_list('id', flat=True)), {b.id for b in self.old})
+        summary = ReturnedBook.objects.get(user=self.reader, book=self.book)
+        self.assertEqual((summary.loans, summary.late_fees), (2, Decimal('3.00')))
+        self.charge.refresh_from_db()
+        self.assertEqual((self.charge.borrowing_id, self.charge.archived_borrowing_id), (None, self.old[0].id))
+
+        self.assertEqual(Book.objects.get(id=self.book.id).total_borrowed, 4)
+        response = self.client.get(reverse('my_borrowings'))
+        self.assertEqual(response.context['archived_count'], 2)
+        self.assertEqual(len(response.context['archived_borrowings']), 2)
+        self.assertEqual(response.context['total_late_fees'], Decimal('3.00'))
+        self.assertEqual(self.client.get(reverse('profile')).context['total_borrowed'], 4)
+
+    def test_review_eligibility_survives_archival(self):
+        self.recent.delete()
+        call_command('archive_borrowings', stdout=StringIO())
+        self.assertFalse(Borrowing.objects.filter(status='RETURNED').exists())
+        response = self.client.get(reverse('submit_review', args=[self.book.id]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_second_run_adds_to_summary(self):
+        call_command('archive_borrowings', '--days', '350', stdout=StringIO())
+        self.assertEqual(ReturnedBook.objects.get().loans, 1)
+        call_command('archive_borrowings', stdout=StringIO())
+        self.assertEqual(ReturnedBook.objects.get().loans, 2)
+
+    def test_loans_not_yet_rolled_up_stay(self):
+        RollupWatermark.objects.filter(name='daily_rollup').update(processed_until=timezone.now() - timedelta(days=350))
+        call_command('archive_borrowings', stdout=StringIO())
+        self.assertEqual(list(ArchivedBorrowing.objects.values_list('id', flat=True)), [self.old[0].id])
+
+    def test_staff_can_list_archived_loans(self):
+        call_command('archive_borrowings', stdout=StringIO())
+        self.reader.is_staff = True
+        self.reader.save()
+        response = self.client.get(reverse('manage_all_borrowings'), {'status': 'ARCHIVED', 'search': 'dune'})
+        self.assertEqual(response.context['total_borrowings'], 2)
+        self.assertNotContains(response, f'updateModal{self.old[0].id}')
+
+
+class LargeTableAdminTest(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username="admin", password="lithan")
+        self.client.force_login(self.admin)
+        self.book = Book.objects.create(
+            title="Dune", author="Frank Herbert", isbn="9780441013593", description="",
+            category="Novel", published_date=date(1965, 8, 1),
+        )
+
+    def borrow(self, count):
+        due = timezone.now() + timedelta(days=14)
+        for _ in range(count):
+            reader = User.objects.create_user(username=f"reader{User.objects.count()}")
+            Borrowing.objects.create(book=self.book, user=reader, due_date=due)
+
+    def test_unfiltered_count_is_estimated(self):
+        with mock.patch.object(library_admin, 'estimated_row_count', return_value=5_000_000):
+            response = self.client.get(reverse('admin:library_borrowing_changelist'))
+        self.assertEqual(response.context['cl'].result_count, 5_000_000)
+        self.assertContains(response, "about 5,000,000 borrowings")
+
+    def test_filtered_count_is_capped(self):
+        self.borrow(3)
+        with mock.patch.object(library_admin, 'COUNT_CAP', 2):
+            response = self.client.get(reverse('admin:library_borrowing_changelist'), {'status__exact': 'BORROWED'})
+        self.assertEqual(response.context['cl'].result_count, 2)
+        self.assertContains(response, "2+ borrowings")
+
+    def test_pages_past_the_capped_count_are_reachable(self):
+        self.borrow(5)
+        url = reverse('admin:library_borrowing_changelist')
+        with mock.patch.object(library_admin, 'COUNT_CAP', 2), \
+                mock.patch.object(library_admin.BorrowingAdmin, 'list_per_page', 1):
+            response = self.client.get(url, {'status__exact': 'BORROWED', 'p': 4})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.context['cl'].result_list), 1)
+            self.assertContains(response, '?p=5&amp;status__exact=BORROWED')
+            response = self.client.get(url, {'status__exact': 'BORROWED', 'p': 5})
+            self.assertNotContains(response, 'p=6')
+            response = self.client.get(url, {'status__exact': 'BORROWED', 'p': 6})
+        self.assertRedirects(response, f'{url}?e=1', fetch_redirect_response=False)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        url = reverse('admin:library_borrowing_changelist')
+        self.borrow(2)
+        self.client.get(url)  # Caches the session user
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(url)
+        self.borrow(8)
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(url)
+        self.assertEqual(len(few), len(many))
+
+    def test_book_filters_do_not_scan_for_distinct_values(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:library_book_changelist'), {'decade': '1960', 'q': 'dun'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.book])
+        self.assertFalse(any('DISTINCT' in query['sql'] for query in queries))
@@ -0,0 +1,130 @@
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .models import Book
+
+# Each process keeps its own index. Changes made in this process are applied
+# in place (see signals); changes made by other processes are noticed through
+# the books' fingerprint in the database (row count and latest updated_at),
+# checked at most once per interval, and trigger a rebuild.
+CHECK_INTERVAL = getattr(settings, 'TYPEAHEAD_CHECK_INTERVAL', 30)  # Seconds
+MAX_RESULTS = 8
+
+
+def normalize(text):
+    """Case- and accent-insensitive form used for index keys and queries"""
+    text = unicodedata.normalize('NFKD', text)
+    return ' '.join(''.join(c for c in text if not unicodedata.combining(c)).casefold().split())
+
+
+def index_keys(title, author):
+    """Keys for a book: its title and author from every word onward, so "herb" finds "Frank Herbert" """
+    keys = set()
+    for text in (title, author):
+        words = normalize(text).split()
+        for i in range(len(words)):
+            keys.add(' '.join(words[i:]))
+    return keys
+
+
+class PrefixIndex:
+    """
+    Sorted array of (key, book id) pairs searched with bisect.
+
+    Lookups read an immutable snapshot, so they never lock; updates build a
+    new snapshot and swap it in. Book changes are rare next to keystrokes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None  # (keys, book_ids, books by id)
+        self._version = None  # Fingerprint of the books the snapshot was built from
+        self._checked_at = 0
+
+    def build(self):
+        with self._lock:
+            version = fingerprint()
+            books = {
+                book_id: (title, author)
+                for book_id, title, author in Book.objects.values_list('id', 'title', 'author')
+            }
+            entries = sorted(
+                (key, book_id) for book_id, (title, author) in books.items() for key in index_keys(title, author))
+            self._snapshot = ([key for key, _ in entries], [book_id for _, book_id in entries], books)
+            self._version = version
+            self._checked_at = time.monotonic()
+
+    def _current(self):
+        """The snapshot, rebuilt first if it is missing or the books changed in the database"""
+        if self._snapshot is None:
+            self.build()
+        elif time.monotonic() - self._checked_at >= CHECK_INTERVAL:
+            self._checked_at = time.monotonic()
+            if fingerprint() != self._version:
+                self.build()
+        return self._snapshot
+
+    def search(self, query, limit=MAX_RESULTS):
+        """Up to limit (id, title, author) tuples whose title or author has a word starting with query"""
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        keys, book_ids, books = self._current()
+        results = []
+        seen = set()
+        i = bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix) and len(results) < limit:
+            book_id = book_ids[i]
+            if book_id not in seen:
+                seen.add(book_id)
+                results.append((book_id, *books[book_id]))
+            i += 1
+        return results
+
+    def update(self, book_id, title=None, author=None):
+        """
+        Re-index one book (or drop it when title is None) after a change in this process.
+
+        The stored fingerprint is refreshed too, so the change is not mistaken
+        for another process's; one made by another process at the same moment
+        is then only picked up with the next rebuild.
+        """
+        with self._lock:
+            if self._snapshot is None:
+                return  # Built on the next search
+            indexed = None if title is None else (title, author)
+            self._version = fingerprint()
+            if self._snapshot[2].get(book_id) == indexed:
+                return  # Nothing indexed changed
+            keys, book_ids, books = self._snapshot
+            keys, book_ids, books = list(keys), list(book_ids), dict(books)
+            if book_id in books:
+                for key in index_keys(*books.pop(book_id)):
+                    i = bisect_left(keys, key)
+                    while book_ids[i] != book_id:
+                        i += 1
+                    del keys[i], book_ids[i]
+            if title is not None:
+                books[book_id] = (title, author)
+                for key in index_keys(title, author):
+                    i = bisect_left(keys, key)
+                    while i < len(keys) and keys[i] == key and book_ids[i] < book_id:
+                        i += 1
+                    keys.insert(i, key)
+                    book_ids.insert(i, book_id)
+            self._snapshot = (keys, book_ids, books)
+
+
+def fingerprint():
+    """Changes whenever a book is added, saved or deleted"""
+    totals = Book.objects.aggregate(books=Count('id'), changed=Max('updated_at'))
+    return totals['books'], totals['changed']
+
+
+# One index per process, built on the first search
+index = PrefixIndex()
@@ -0,0 +1,136 @@
+from io import BytesIO
+
+from django import forms
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from django.db import models
+from django.db.models.fields.files import FieldFile
+from django.template.defaultfilters import filesizeformat
+from PIL import Image
+
+# Limits shared by every image field (covers and profile pictures)
+MAX_IMAGE_UPLOAD_SIZE = getattr(settings, 'MAX_IMAGE_UPLOAD_SIZE', 5 * 1024 * 1024)
+MAX_IMAGE_DIMENSION = getattr(settings, 'MAX_IMAGE_DIMENSION', 6000)
+IMAGE_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+
+
+def sniff_image_format(head):
+    """Image format named by a file's leading bytes, or None"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'GIF'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def too_large_message():
+    return f"Image is too large. Maximum size is {filesizeformat(MAX_IMAGE_UPLOAD_SIZE)}."
+
+
+class RejectedUpload(UploadedFile):
+    """Empty stand-in for a file the upload handler refused; rejection says why"""
+
+    def __init__(self, name, content_type, rejection):
+        super().__init__(BytesIO(), name, content_type, 0)
+        self.rejection = rejection
+
+
+class ImageUploadHandler(FileUploadHandler):
+    """
+    Refuses oversize and non-image files while the request is still streaming.
+
+    Must be listed before the handler that stores uploads. Once a file is
+    refused its remaining chunks are dropped instead of being passed on, and
+    it appears in request.FILES as a RejectedUpload that fails validation, so
+    the form reports the reason and nothing is saved.
+    """
+
+    def new_file(self, field_name, file_name, content_type, content_length, *args, **kwargs):
+        super().new_file(field_name, file_name, content_type, content_length, *args, **kwargs)
+        self.rejection = None
+        if content_length is not None and content_length > MAX_IMAGE_UPLOAD_SIZE:
+            self.rejection = too_large_message()
+            raise StopFutureHandlers  # Nothing is stored for this file
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.rejection:
+            return None
+        if start + len(raw_data) > MAX_IMAGE_UPLOAD_SIZE:
+            self.rejection = too_large_message()
+        elif start == 0 and sniff_image_format(raw_data[:12]) is None:
+            self.rejection = "Upload a JPEG, PNG, GIF or WebP image."
+        return None if self.rejection else raw_data
+
+    def file_complete(self, file_size):
+        if self.rejection:
+            return RejectedUpload(self.file_name, self.content_type, self.rejection)
+        if file_size == 0:
+            return RejectedUpload(self.file_name, self.content_type, "The submitted file is empty.")
+        return None  # Let the next handler return the stored file
+
+
+def validate_image_upload(file):
+    """
+    Check a newly uploaded image's size, format and dimensions.
+
+    Only the image header is parsed; pixel data is never decoded. Files that
+    are already stored are not re-read.
+    """
+    if isinstance(file, FieldFile):
+        if file._committed:
+            return
+        file = file.file  # The UploadedFile assigned to the model field
+    if getattr(file, 'rejection', None):
+        raise ValidationError(file.rejection, code='invalid_image')
+    if getattr(file, 'image_checked', False):
+        return  # Already checked by the form field
+    if file.size > MAX_IMAGE_UPLOAD_SIZE:
+        raise ValidationError(too_large_message(), code='file_too_large')
+
+    try:
+        file.seek(0)
+        with Image.open(file) as image:  # Lazy: reads the header only
+            image_format, (width, height) = image.format, image.size
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        raise ValidationError("Upload a valid image. The file is not an image or is corrupted.",
+                              code='invalid_image')
+    finally:
+        file.seek(0)
+
+    if image_format not in IMAGE_FORMATS:
+        raise ValidationError("Upload a JPEG, PNG, GIF or WebP image.", code='invalid_image')
+    if width > MAX_IMAGE_DIMENSION or height > MAX_IMAGE_DIMENSION:
+        raise ValidationError(
+            f"Image is {width}x{height} pixels; the maximum is {MAX_IMAGE_DIMENSION} pixels per side.",
+            code='invalid_image')
+    file.image_checked = True
+
+
+class ImageUploadFormField(forms.FileField):
+    """Form field for ImageUploadField: header-only validation instead of a full decode"""
+    default_validators = [validate_image_upload]
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('widget', forms.ClearableFileInput(attrs={'accept': 'image/*'}))
+        super().__init__(**kwargs)
+
+    def to_python(self, data):
+        # Report the handler's reason rather than "The submitted file is empty."
+        rejection = getattr(data, 'rejection', None)
+        if rejection:
+            raise ValidationError(rejection, code='invalid_image')
+        return super().to_python(data)
+
+
+class ImageUploadField(models.ImageField):
+    """ImageField with the library's upload limits, used for every image field"""
+    default_validators = [validate_image_upload]
+
+    def formfield(self, **kwargs):
+        return super().formfield(**{'form_class': ImageUploadFormField, **kwargs})
@@ -19,10 +19,16 @@ from django.contrib import admin
 from django.urls import include, path
 from django.conf import settings
 from django.conf.urls.static import static  # Add this import
+from library import views as library_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('library/', include('library.urls')),
+    path('library/books/typeahead/', library_views.book_typeahead, name='book_typeahead'),
+    path('library/analytics/', library_views.library_analytics, name='library_analytics'),
+    path('library/manage/bulk/', library_views.bulk_update_borrowings, name='bulk_update_borrowings'),
+    path('library/manage/desk/', library_views.circulation_desk, name='circulation_desk'),
+    path('library/manage/reviews/', library_views.review_moderation, name='review_moderation'),
 ]
 
 urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
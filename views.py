@@ -1,7 +1,17 @@
 from django.shortcuts import redirect, render
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.http import Http404, JsonResponse
 from .form import Bookform, ReviewForm
-from .models import Book, UserProfile, Borrowing, Review
+from .analytics import WATERMARK_NAME
+from .archival import archived_totals, has_returned
+from .fees import settle_return, user_balance
+from .memo import now as request_now
+from .reviews import allow_review, moderate, queue_for_moderation
+from .uploads import validate_image_upload
+from . import facets, typeahead
+from .circulation import MAX_ACTIVE_LOANS, add_copies, aget_availability, aget_loan_state, ainvalidate, bulk_update_status, checkin, checkin_copy, checkout, checkout_copy, invalidate, sync_availability
+from .models import Book, UserProfile, Borrowing, ArchivedBorrowing, FeeLedgerEntry, Review, BookRecommendation, prefetch_book_stats, DailyRollup, RollupWatermark
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages
@@ -9,16 +19,42 @@ from django.contrib.auth import authenticate
 from django.contrib.auth import login as auth_login, logout as auth_logout
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
 from django.contrib.auth.decorators import user_passes_test
+from django.core.exceptions import ValidationError
 from django.core.mail import send_mail
 from django.conf import settings
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, Case, Count, F, Sum, Prefetch, OuterRef, Subquery, Value, When, DecimalField, IntegerField
+from django.db.models.functions import Coalesce
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from datetime import timedelta
 from decimal import Decimal
+import base64
+import json
+from asgiref.sync import sync_to_async
+
+# Async helpers used by the ASGI views below.
+# Template rendering stays synchronous because base.html touches the lazy
+# request.user and the session-backed messages, so it gets a single thread hop
+# after all of the view's queries have run on the async ORM.
+_arender = sync_to_async(render)
+
+# SMTP is blocking network I/O that does not touch the database, so it does not
+# need to run on the shared sync thread.
+_asend_mail = sync_to_async(send_mail, thread_sensitive=False)
+
+async def _aget_or_404(queryset, **kwargs):
+    """Async counterpart of get_object_or_404 for a queryset or model"""
+    if not hasattr(queryset, 'aget'):
+        queryset = queryset._default_manager.all()
+    try:
+        return await queryset.aget(**kwargs)
+    except queryset.model.DoesNotExist:
+        raise Http404(f"No {queryset.model._meta.object_name} matches the given query.")
 
 # Create your views here.
 # List all books
-def book_list(request):
+async def book_list(request):
     books = Book.objects.all()
     
     # Search functionality
@@ -30,11 +66,37 @@ def book_list(request):
             Q(genre__icontains=search)
         )
     
-    return render(request, 'book_list.html', {'books': books})
+    # Facet counts for the search results, from one grouped query
+    filters = facets.parse_filters(request.GET)
+    counts = facets.count_facets([row async for row in facets.facet_rows(books)], filters)
+    
+    books = facets.apply_filters(books, filters).prefetch_related(
+        # Neighbours for the detail modals, fetched in one query for the page
+        Prefetch('recommendations',
+                 queryset=BookRecommendation.objects.select_related('recommended_book'))
+    )
+    books = [book async for book in books]
+    # Ratings and borrow counts for every row in two grouped queries
+    books = await sync_to_async(prefetch_book_stats)(books)
+    return await _arender(request, 'book_list.html', {
+        'books': books,
+        'facets': facets.build_facets(request.GET, counts, filters),
+        'has_filters': any(filters.values()),
+    })
 
-def home(request):
+# Typeahead suggestions for the search boxes, served from the in-memory prefix
+# index without touching the database
+def book_typeahead(request):
+    query = request.GET.get('q', '')[:100]
+    results = [
+        {'id': book_id, 'title': title, 'author': author, 'url': reverse('book_reviews', args=[book_id])}
+        for book_id, title, author in typeahead.index.search(query)
+    ]
+    return JsonResponse({'results': results})
+
+async def home(request):
     message = "Welcome to the Library Management System"
-    return render(request, 'home.html', {'message': message})
+    return await _arender(request, 'home.html', {'message': message})
 
 #Delete Book View
 def delete_book(request, book_id):
@@ -49,15 +111,149 @@ def delete_book(request, book_id):
 def is_admin(user):
     return user.is_superuser
 
+# Sort options for the user dashboard: name -> (field, descending)
+USER_SORTS = {
+    'newest': ('date_joined', True),
+    'oldest': ('date_joined', False),
+    'username': ('username', False),
+    'active': ('active_borrowings', True),
+    'overdue': ('overdue_count', True),
+    'fees': ('outstanding_fees', True),
+}
+USERS_PER_PAGE = 50
+
+def _borrowing_stat(aggregate, output_field, *filters):
+    """
+    Correlated per-user aggregate over Borrowing.
+
+    Shown only, it is evaluated for the rows on the page. Sorting by it
+    ('active', 'overdue', 'fees') or filtering on it (has_overdue) makes the
+    database evaluate it for every matching user before the LIMIT, so those
+    views cost a pass over the users and their loans.
+    """
+    stat = (
+        Borrowing.objects.filter(*filters, user=OuterRef('pk'))
+        .order_by()
+        .values('user')
+        .annotate(value=aggregate)
+        .values('value')
+    )
+    return Coalesce(Subquery(stat, output_field=output_field), Value(0), output_field=output_field)
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def _parse_cursor_datetime(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(value)
+    return parsed
+
+def _cursor_decimal(value):
+    value = Decimal(str(value))
+    if not value.is_finite():
+        raise ValueError(value)
+    return value
+
+def _cursor_str(value):
+    if not isinstance(value, str):
+        raise TypeError(value)
+    return value
+
+# How the last row's sort value is read back from a cursor, per sort field
+CURSOR_TYPES = {
+    'date_joined': _parse_cursor_datetime,
+    'username': _cursor_str,
+    'active_borrowings': int,
+    'overdue_count': int,
+    'outstanding_fees': _cursor_decimal,
+}
+
+def _decode_cursor(cursor, field):
+    """(sort value, id) of the last row shown, or None for a missing or malformed cursor"""
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return CURSOR_TYPES[field](value), int(pk)
+    except (ValueError, TypeError, ArithmeticError):
+        return None
+
 @user_passes_test(is_admin)
 def user_dashboard(request):
-    users = User.objects.all().order_by('-date_joined')
-    stats = {
-        'total': users.count(),
-        'staff': users.filter(is_staff=True).count(),
-        'recent': users.filter(is_active=True).count(),
-    }
-    return render(request, 'user_dashboard.html', {'users': users, 'stats': stats})
+    stats = User.objects.aggregate(
+        total=Count('id'),
+        staff=Count('id', filter=Q(is_staff=True)),
+        active=Count('id', filter=Q(is_active=True)),
+    )
+    
+    fee_field = DecimalField(max_digits=12, decimal_places=2)
+    users = User.objects.annotate(
+        active_borrowings=_borrowing_stat(
+            Count('id'), IntegerField(), Q(status__in=['BORROWED', 'OVERDUE'])),
+        overdue_count=_borrowing_stat(
+            Count('id'), IntegerField(),
+            Q(status='OVERDUE') | Q(status='BORROWED', due_date__lt=timezone.now())),
+        # Ledger balance, as user_balance() computes it: charges minus payments and waivers
+        outstanding_fees=Coalesce(
+            Subquery(FeeLedgerEntry.objects.filter(user=OuterRef('pk')).order_by().values('user')
+                     .annotate(value=Sum(Case(When(entry_type='CHARGE', then=F('amount')), default=-F('amount'))))
+                     .values('value'), output_field=fee_field),
+            Value(0), output_field=fee_field),
+        # Fees still accruing on open loans, not yet charged to the ledger
+        accrued_fees=_borrowing_stat(
+            Sum('late_fee'), fee_field, Q(status__in=['BORROWED', 'OVERDUE'], returned_date__isnull=True)),
+    )
+    
+    # Filters
+    search = request.GET.get('search', '').strip()
+    if search:
+        users = users.filter(Q(username__istartswith=search) | Q(email__istartswith=search))
+    role = request.GET.get('role', '')
+    if role == 'staff':
+        users = users.filter(is_staff=True)
+    elif role == 'member':
+        users = users.filter(is_staff=False)
+    if request.GET.get('has_overdue'):
+        users = users.filter(overdue_count__gt=0)
+    
+    # Keyset pagination: continue after the (sort value, id) of the last row shown
+    sort = request.GET.get('sort', 'newest')
+    if sort not in USER_SORTS:
+        sort = 'newest'
+    field, descending = USER_SORTS[sort]
+    cursor = _decode_cursor(request.GET.get('after', ''), field)
+    if cursor:
+        value, pk = cursor
+        after = 'lt' if descending else 'gt'
+        users = users.filter(
+            Q(**{f'{field}__{after}': value}) | Q(**{field: value, f'id__{after}': pk})
+        )
+    prefix = '-' if descending else ''
+    page = list(users.order_by(f'{prefix}{field}', f'{prefix}id')[:USERS_PER_PAGE + 1])
+    
+    next_cursor = None
+    if len(page) > USERS_PER_PAGE:
+        page = page[:USERS_PER_PAGE]
+        last = page[-1]
+        last_value = getattr(last, field)
+        next_cursor = _encode_cursor([
+            last_value.isoformat() if hasattr(last_value, 'isoformat') else str(last_value),
+            last.id,
+        ])
+    
+    params = request.GET.copy()
+    params.pop('after', None)
+    
+    return render(request, 'user_dashboard.html', {
+        'users': page,
+        'stats': stats,
+        'sort': sort,
+        'search': search,
+        'role': role,
+        'has_overdue': bool(request.GET.get('has_overdue')),
+        'next_cursor': next_cursor,
+        'is_first_page': cursor is None,
+        'query_string': params.urlencode(),
+    })
 
 @user_passes_test(is_admin)
 def user_create(request):
@@ -92,7 +288,9 @@ def book_create(request):
         form = Bookform(request.POST, request.FILES)
 
         if form.is_valid():
-            form.save()
+            book = form.save()
+            # Every new book is circulated by barcoded copy
+            add_copies(book, book.available_copies)
             return redirect('book_list')
     else:
         form = Bookform()
@@ -107,7 +305,14 @@ def book_update(request, book_id):
         form = Bookform(request.POST, request.FILES, instance=book)
 
         if form.is_valid():
-            form.save()
+            with transaction.atomic():
+                form.save()
+                if form.tracks_copies:
+                    if form.cleaned_data.get('new_copies'):
+                        add_copies(book, form.cleaned_data['new_copies'])
+                    # The saved row holds the count from when the page was loaded
+                    sync_availability([book.id])
+                    transaction.on_commit(lambda: invalidate(book_id=book.id))
             messages.success(request, f"'{book.title}' updated successfully!")
             return redirect('book_list')
     else:
@@ -169,6 +374,14 @@ def register(request):
         elif password != password_confirm:
             error_messages.append("Passwords do not match.")
         
+        # Validate the profile picture before anything is written (the upload
+        # handler has already refused oversize or non-image files)
+        if profile_pic:
+            try:
+                validate_image_upload(profile_pic)
+            except ValidationError as e:
+                error_messages.extend(e.messages)
+        
         # Validate terms and conditions
         if not terms:
             error_messages.append("You must agree to the Terms and Conditions.")
@@ -190,35 +403,20 @@ def register(request):
         
         # Create the user
         try:
-            user = User.objects.create_user(
-                username=username,
-                first_name=first_name,
-                last_name=last_name,
-                email=email,
-                password=password
-            )
-            
-            # Create user profile
-            profile = UserProfile.objects.create(user=user, bio=bio)
-            
-            # Handle profile picture if provided
-            if profile_pic:
-                # Check file size (5MB max)
-                if profile_pic.size > 5 * 1024 * 1024:
-                    messages.error(request, "Profile picture is too large. Maximum size is 5MB.")
-                    user.delete()  # Rollback user creation
-                    context = {
-                        'username': username,
-                        'first_name': first_name,
-                        'last_name': last_name,
-                        'email': email,
-                        'bio': bio,
-                    }
-                    return render(request, 'register.html', context)
+            with transaction.atomic():
+                user = User.objects.create_user(
+                    username=username,
+                    first_name=first_name,
+                    last_name=last_name,
+                    email=email,
+                    password=password
+                )
                 
-                profile.profile_pic = profile_pic
-            
-            profile.save()
+                # Create user profile, with the already validated picture
+                profile = UserProfile(user=user, bio=bio)
+                if profile_pic:
+                    profile.profile_pic = profile_pic
+                profile.save()
             
             # Send confirmation email
             try:
@@ -291,9 +489,9 @@ def logout(request):
 
 @login_required(login_url='login')
 def profile(request):
-    # Get or create user profile using UserProfile model
+    # Get or create user profile (loaded together with request.user by CachedModelBackend)
     try:
-        profile = UserProfile.objects.get(user=request.user)
+        profile = request.user.profile
     except UserProfile.DoesNotExist:
         # Create a profile if it doesn't exist
         profile = UserProfile.objects.create(user=request.user)
@@ -303,6 +501,15 @@ def profile(request):
         bio = request.POST.get('bio', '').strip()
         profile_pic = request.FILES.get('profile_pic')
         
+        # Reject a bad picture before saving any of the other changes
+        if profile_pic:
+            try:
+                validate_image_upload(profile_pic)
+            except ValidationError as e:
+                for error in e.messages:
+                    messages.error(request, error)
+                return redirect('profile')
+        
         # Also update user's first and last name if provided
         first_name = request.POST.get('first_name', '').strip()
         last_name = request.POST.get('last_name', '').strip()
@@ -330,7 +537,7 @@ def profile(request):
 
     # GET request → show the current profile data
     # Update statistics with actual data
-    total_borrowed = Borrowing.objects.filter(user=request.user).count()
+    total_borrowed = Borrowing.objects.filter(user=request.user).count() + archived_totals(request.user.id)[0]
     reviews_count = Review.objects.filter(user=request.user).count()
     currently_reading = Borrowing.objects.filter(user=request.user, status='BORROWED').count()
     
@@ -358,51 +565,22 @@ def user_delete(request, user_id):
 # BORROWING AND RATING FUNCTIONALITY
 
 @login_required
-def borrow_book(request, book_id):
-    book = get_object_or_404(Book, id=book_id)
-    
-    if not book.can_borrow():
-        messages.error(request, "Sorry, this book is currently unavailable.")
-        return redirect('book_list')
-    
-    # Check if user already has this book borrowed
-    existing_borrowing = Borrowing.objects.filter(
-        book=book, 
-        user=request.user, 
-        status='BORROWED'
-    ).exists()
-    
-    if existing_borrowing:
-        messages.warning(request, "You have already borrowed this book.")
-        return redirect('book_list')
-    
-    # Check user's borrowing limit (max 5 books)
-    active_borrowings = Borrowing.objects.filter(
-        user=request.user, 
-        status='BORROWED'
-    ).count()
-    
-    if active_borrowings >= 5:
-        messages.error(request, "You have reached the borrowing limit (5 books). Please return some books first.")
-        return redirect('my_borrowings')
+async def borrow_book(request, book_id):
+    book = await _aget_or_404(Book, id=book_id)
+    user = await request.auser()
     
     if request.method == 'POST':
-        borrowing = Borrowing.objects.create(
-            book=book,
-            user=request.user,
-            due_date=timezone.now() + timedelta(days=14),
-            status='BORROWED'
-        )
-        
-        # Update book available copies
-        book.available_copies -= 1
-        book.save()
+        # checkout() locks the rows and checks availability and the loan rules
+        # against the database, whatever the cache says
+        borrowing, refusal = await sync_to_async(checkout)(book, user, timezone.now() + timedelta(days=14))
+        if refusal:
+            return _refuse_borrow(request, refusal)
         
         # Send email notification
         try:
             subject = f'Book Borrowed: {book.title}'
             message = f'''
-Hello {request.user.first_name},
+Hello {user.first_name},
 
 You have successfully borrowed "{book.title}" by {book.author}.
 
@@ -415,11 +593,11 @@ Please return the book by the due date to avoid late fees.
 
 Thank you for using Silent Library!
             '''
-            send_mail(
+            await _asend_mail(
                 subject,
                 message,
                 settings.DEFAULT_FROM_EMAIL,
-                [request.user.email],
+                [user.email],
                 fail_silently=True,
             )
         except Exception as e:
@@ -428,7 +606,37 @@ Thank you for using Silent Library!
         messages.success(request, f"You have successfully borrowed '{book.title}'!")
         return redirect('my_borrowings')
     
-    return render(request, 'confirm_borrow.html', {'book': book})
+    # The confirmation page is served from the write-through circulation
+    # cache. A cached refusal may be stale (another worker's cache saw the
+    # return), so it is re-read from the database before it is shown.
+    refusal = await _aborrow_refusal(book.id, user.id)
+    if refusal:
+        await ainvalidate(user_id=user.id, book_id=book.id)
+        refusal = await _aborrow_refusal(book.id, user.id)
+    if refusal:
+        return _refuse_borrow(request, refusal)
+    return await _arender(request, 'confirm_borrow.html', {'book': book})
+
+async def _aborrow_refusal(book_id, user_id):
+    """Why the cached circulation state says the user may not borrow the book, or None"""
+    if await aget_availability(book_id) <= 0:
+        return 'unavailable'
+    borrowed_book_ids = await aget_loan_state(user_id)
+    if book_id in borrowed_book_ids:
+        return 'already borrowed'
+    if len(borrowed_book_ids) >= MAX_ACTIVE_LOANS:
+        return 'limit'
+    return None
+
+def _refuse_borrow(request, refusal):
+    if refusal == 'already borrowed':
+        messages.warning(request, "You have already borrowed this book.")
+        return redirect('book_list')
+    if refusal == 'limit':
+        messages.error(request, f"You have reached the borrowing limit ({MAX_ACTIVE_LOANS} books). Please return some books first.")
+        return redirect('my_borrowings')
+    messages.error(request, "Sorry, this book is currently unavailable.")
+    return redirect('book_list')
 
 @login_required
 def return_book(request, borrowing_id):
@@ -440,45 +648,47 @@ def return_book(request, borrowing_id):
     
     if request.method == 'POST':
         borrowing.status = 'RETURNED'
-        borrowing.returned_date = timezone.now()
         
-        # Calculate late fee if overdue
-        if borrowing.is_overdue():
-            borrowing.late_fee = borrowing.calculate_late_fee()
-            messages.warning(request, f"Book returned late. Late fee: ${borrowing.late_fee}")
-        
-        borrowing.save()
+        with transaction.atomic():
+            # Finalise the late fee and post it to the fee ledger
+            if settle_return(borrowing, timezone.now()) > 0:
+                messages.warning(request, f"Book returned late. Late fee: ${borrowing.late_fee}")
+            
+            borrowing.save()
+            
+            # Update book available copies
+            checkin(borrowing)
         
-        # Update book available copies
         book = borrowing.book
-        book.available_copies += 1
-        book.save()
-        
         messages.success(request, f"You have returned '{book.title}' successfully!")
         return redirect('my_borrowings')
     
     return render(request, 'confirm_return.html', {'borrowing': borrowing})
 
+ARCHIVED_HISTORY_SHOWN = 50  # Most recent archived loans listed on My Borrowings
+
 @login_required
 def my_borrowings(request):
-    borrowings = Borrowing.objects.filter(user=request.user).order_by('-borrowed_date')
+    borrowings = Borrowing.objects.filter(user=request.user).select_related('book').order_by('-borrowed_date')
     
     # Update overdue status
-    for borrowing in borrowings.filter(status='BORROWED'):
-        if borrowing.is_overdue():
-            borrowing.status = 'OVERDUE'
-            borrowing.save()
+    borrowings.filter(status='BORROWED', due_date__lt=request_now()).update(status='OVERDUE')
     
-    # Calculate statistics
-    total_late_fees = Decimal('0.00')
-    for b in borrowings:
-        total_late_fees += b.late_fee
+    # Calculate statistics from the stored fees, archived loans included
+    archived_count, archived_fees = archived_totals(request.user.id)
+    total_late_fees = (borrowings.aggregate(total=Sum('late_fee'))['total'] or Decimal('0.00')) + archived_fees
     
     context = {
         'active_borrowings': borrowings.filter(status='BORROWED'),
         'overdue_borrowings': borrowings.filter(status='OVERDUE'),
         'returned_borrowings': borrowings.filter(status='RETURNED'),
+        'archived_borrowings': (
+            ArchivedBorrowing.objects.filter(user=request.user).select_related('book')
+            .order_by('-returned_date')[:ARCHIVED_HISTORY_SHOWN]
+        ) if archived_count else [],
+        'archived_count': archived_count,
         'total_late_fees': total_late_fees,
+        'fee_balance': user_balance(request.user),
     }
     return render(request, 'my_borrowings.html', context)
 
@@ -487,13 +697,7 @@ def submit_review(request, book_id):
     book = get_object_or_404(Book, id=book_id)
     
     # Check if user has borrowed this book before
-    has_borrowed = Borrowing.objects.filter(
-        book=book, 
-        user=request.user, 
-        status='RETURNED'
-    ).exists()
-    
-    if not has_borrowed:
+    if not has_returned(request.user.id, book.id):
         messages.error(request, "You can only review books you have borrowed and returned.")
         return redirect('book_list')
     
@@ -503,11 +707,14 @@ def submit_review(request, book_id):
     if request.method == 'POST':
         form = ReviewForm(request.POST, instance=existing_review)
         if form.is_valid():
+            if not allow_review(request.user.id):
+                messages.error(request, "You have submitted too many reviews recently. Please try again later.")
+                return redirect('book_reviews', book_id=book.id)
             review = form.save(commit=False)
             review.book = book
             review.user = request.user
-            review.save()
-            messages.success(request, "Thank you for your review!")
+            queue_for_moderation(review)
+            messages.success(request, "Thank you for your review! It will appear once it has been checked.")
             return redirect('book_list')
     else:
         form = ReviewForm(instance=existing_review)
@@ -519,33 +726,58 @@ def submit_review(request, book_id):
     })
 
 @login_required
-def book_reviews(request, book_id):
-    book = get_object_or_404(Book, id=book_id)
-    reviews = Review.objects.filter(book=book).order_by('-created_at')
+async def book_reviews(request, book_id):
+    book = await _aget_or_404(Book, id=book_id)
+    user = await request.auser()
+    reviews = [
+        review async for review in Review.objects.filter(book=book)
+        .filter(Q(status='APPROVED') | Q(user_id=user.id))  # Own reviews show while pending
+        .select_related('user', 'user__profile')
+        .order_by('-created_at')
+    ]
+    recommendations = [
+        rec async for rec in book.recommendations.select_related('recommended_book')
+    ]
+    
+    # Rating breakdown is computed from the reviews already loaded
+    approved = [review for review in reviews if review.status == 'APPROVED']
+    rating_counts = {rating: 0 for rating in range(1, 6)}
+    for review in approved:
+        rating_counts[review.rating] += 1
+    average_rating = round(sum(r.rating for r in approved) / len(approved), 1) if approved else 0
     
     # Check if current user has reviewed this book
     user_has_reviewed = False
     user_review = None
-    if request.user.is_authenticated:
-        user_review = book.get_user_review(request.user)
-        user_has_reviewed = book.has_user_reviewed(request.user)
+    if user.is_authenticated:
+        user_review = next((r for r in reviews if r.user_id == user.id), None)
+        user_has_reviewed = user_review is not None
     
-    return render(request, 'book_reviews.html', {
+    return await _arender(request, 'book_reviews.html', {
         'book': book,
         'reviews': reviews,
-        'average_rating': book.average_rating,
+        'average_rating': average_rating,
+        'review_count': len(approved),
         'user_has_reviewed': user_has_reviewed,
         'user_review': user_review,
+        'rating_5_count': rating_counts[5],
+        'rating_4_count': rating_counts[4],
+        'rating_3_count': rating_counts[3],
+        'rating_2_count': rating_counts[2],
+        'rating_1_count': rating_counts[1],
+        'recommendations': recommendations,
     })
 
 # Staff view to manage all borrowings
 @user_passes_test(lambda u: u.is_superuser or u.is_staff)
 def manage_all_borrowings(request):
-    borrowings = Borrowing.objects.all().order_by('-borrowed_date')
+    borrowings = Borrowing.objects.select_related('book', 'user').order_by('-borrowed_date')
     
-    # Filter by status if provided
+    # Filter by status if provided; archived loans are only searched when asked for
     status_filter = request.GET.get('status', '')
-    if status_filter:
+    if status_filter == 'ARCHIVED':
+        borrowings = ArchivedBorrowing.objects.select_related('book', 'user').order_by('-borrowed_date')
+    elif status_filter:
         borrowings = borrowings.filter(status=status_filter)
     
     # Search functionality
@@ -559,9 +791,12 @@ def manage_all_borrowings(request):
     
     # Calculate statistics
     total_borrowings = borrowings.count()
-    overdue_count = borrowings.filter(status='OVERDUE').count()
-    active_count = borrowings.filter(status='BORROWED').count()
-    total_late_fees = sum(b.late_fee for b in borrowings)
+    if status_filter == 'ARCHIVED':
+        overdue_count = active_count = 0
+    else:
+        overdue_count = borrowings.filter(status='OVERDUE').count()
+        active_count = borrowings.filter(status='BORROWED').count()
+    total_late_fees = borrowings.aggregate(total=Sum('late_fee'))['total'] or Decimal('0.00')
     
     context = {
         'borrowings': borrowings,
@@ -583,14 +818,136 @@ def update_borrowing_status(request, borrowing_id):
         new_status = request.POST.get('status')
         borrowing.status = new_status
         
-        if new_status == 'RETURNED' and not borrowing.returned_date:
-            borrowing.returned_date = timezone.now()
-            # Update book available copies
-            borrowing.book.available_copies += 1
-            borrowing.book.save()
-        
-        borrowing.save()
+        with transaction.atomic():
+            if new_status == 'RETURNED' and not borrowing.returned_date:
+                settle_return(borrowing, timezone.now())
+                # Update book available copies
+                checkin(borrowing)
+            
+            borrowing.save()
         messages.success(request, f"Borrowing status updated to {new_status}")
         return redirect('manage_all_borrowings')
     
-    return render(request, 'update_borrowing_status.html', {'borrowing': borrowing})
\ No newline at end of file
+    return render(request, 'update_borrowing_status.html', {'borrowing': borrowing})
+
+# Staff bulk status changes, e.g. processing a stack of returns at inventory time
+@user_passes_test(lambda u: u.is_superuser or u.is_staff)
+def bulk_update_borrowings(request):
+    report = None
+    new_status = request.POST.get('status', 'RETURNED')
+    
+    if request.method == 'POST':
+        valid_statuses = dict(Borrowing.STATUS_CHOICES)
+        borrowing_ids = [int(i) for i in request.POST.getlist('borrowing_ids') if i.strip().isdigit()]
+        # Ids and ISBNs can also be pasted or scanned one per line
+        for line in request.POST.get('borrowing_id_list', '').split():
+            if line.isdigit():
+                borrowing_ids.append(int(line))
+        isbns = [line.strip() for line in request.POST.get('isbn_list', '').splitlines() if line.strip()]
+        
+        if new_status not in valid_statuses:
+            messages.error(request, "Please choose a valid status.")
+        elif not borrowing_ids and not isbns:
+            messages.error(request, "Select borrowings or enter at least one borrowing id or ISBN.")
+        else:
+            report = bulk_update_status(new_status, borrowing_ids=borrowing_ids, isbns=isbns)
+            updated = sum(1 for entry in report if entry['updated'])
+            messages.success(request, f"{updated} of {len(report)} item(s) updated to {valid_statuses[new_status]}.")
+    
+    return render(request, 'bulk_borrowings.html', {
+        'report': report,
+        'status': new_status,
+        'status_choices': Borrowing.STATUS_CHOICES,
+    })
+
+# Moderation queue for reviews held by the spam checks
+@user_passes_test(lambda u: u.is_superuser or u.is_staff)
+def review_moderation(request):
+    if request.method == 'POST':
+        action = request.POST.get('action')
+        review_ids = [int(i) for i in request.POST.getlist('review_ids') if i.isdigit()]
+        if action not in ('APPROVED', 'REJECTED') or not review_ids:
+            messages.error(request, "Select reviews and choose approve or reject.")
+        else:
+            selected = list(Review.objects.filter(id__in=review_ids, status='PENDING'))
+            moderate(selected, action)
+            messages.success(request, f"{len(selected)} review(s) {action.lower()}.")
+        return redirect('review_moderation')
+    
+    pending = Review.objects.filter(status='PENDING').select_related('book', 'user').order_by('created_at')
+    return render(request, 'review_moderation.html', {
+        'reviews': pending[:100],
+        'pending_count': pending.count(),
+    })
+
+# Circulation desk: copies are checked out and in by scanning their barcodes
+@user_passes_test(lambda u: u.is_superuser or u.is_staff)
+def circulation_desk(request):
+    mode = request.POST.get('mode', 'checkin')
+    patron = request.POST.get('patron', '').strip()
+    borrowing = result = None
+    
+    if request.method == 'POST':
+        barcode = request.POST.get('barcode', '').strip()
+        if not barcode:
+            result = "Scan a barcode."
+        elif mode == 'checkout':
+            user = User.objects.filter(username=patron).first()
+            if user is None:
+                result = "Enter the patron's username before scanning."
+            else:
+                borrowing, result = checkout_copy(barcode, user, timezone.now() + timedelta(days=14))
+        else:
+            borrowing, result = checkin_copy(barcode)
+    
+    return render(request, 'circulation_desk.html', {
+        'mode': mode,
+        'patron': patron,
+        'borrowing': borrowing,
+        'result': result,
+    })
+
+def _with_rates(row):
+    """Add overdue rate and average rating to an aggregated rollup row"""
+    row['overdue_rate'] = round(100 * row['overdues'] / row['borrows'], 1) if row['borrows'] else 0
+    row['average_rating'] = round(row['rating_sum'] / row['rating_count'], 1) if row['rating_count'] > 0 else 0
+    return row
+
+# Admin analytics, read only from the precomputed daily rollups
+@user_passes_test(is_admin)
+def library_analytics(request):
+    try:
+        days = min(max(int(request.GET.get('days', 30)), 1), 365)
+    except ValueError:
+        days = 30
+    rollups = DailyRollup.objects.filter(date__gt=timezone.localdate() - timedelta(days=days))
+    sums = {
+        'borrows': Sum('borrows'),
+        'returns': Sum('returns'),
+        'overdues': Sum('overdues'),
+        'late_fees': Sum('late_fees_charged'),
+        'rating_sum': Sum('rating_sum'),
+        'rating_count': Sum('rating_count'),
+    }
+    
+    totals = rollups.aggregate(**sums)
+    totals = _with_rates({key: value or 0 for key, value in totals.items()})
+    
+    genre_names = dict(Book.GENRE_CHOICES)
+    by_genre = [_with_rates(row) for row in rollups.values('genre').annotate(**sums).order_by('genre')]
+    for row in by_genre:
+        row['genre_display'] = genre_names.get(row['genre'], row['genre'])
+    by_category = [_with_rates(row) for row in rollups.values('category').annotate(**sums).order_by('category')]
+    daily = [_with_rates(row) for row in rollups.values('date').annotate(**sums).order_by('-date')]
+    
+    watermark = RollupWatermark.objects.filter(name=WATERMARK_NAME).first()
+    
+    context = {
+        'days': days,
+        'totals': totals,
+        'by_genre': by_genre,
+        'by_category': by_category,
+        'daily': daily,
+        'processed_until': watermark.processed_until if watermark else None,
+    }
+    return render(request, 'analytics.html', context)